@@ -0,0 +1,148 @@
+"""
+Offline beat analysis of songs for the catalog.
+
+The onset strength is the positive spectral flux of the log-compressed magnitude spectrum.
+Tempo is taken from its autocorrelation and a constant-tempo beat grid is fitted to it,
+with each beat then moved to the strongest onset close to it.
+Downbeats are the beats of the bar position with the strongest onsets on average.
+"""
+
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from .mixer import PcmBuffer
+
+HOP_LENGTH = 512
+FRAME_LENGTH = 2048
+PRIOR_BPM = 120
+
+
+def get_onset_strength(samples: np.ndarray, hop_length: int = HOP_LENGTH, frame_length: int = FRAME_LENGTH) -> np.ndarray:
+    """
+    Returns the onset strength per hop of the float32 `samples` of shape (frames, channels).
+    """
+    mono = samples.mean(axis=1, dtype=np.float32) if samples.ndim == 2 else samples
+    if len(mono) < frame_length:
+        return np.zeros(0, dtype=np.float32)
+
+    windows = np.lib.stride_tricks.sliding_window_view(mono, frame_length)[::hop_length]
+    window_function = np.hanning(frame_length).astype(np.float32)
+
+    # In chunks of windows, as the spectrogram of a whole song would take hundreds of MB
+    chunk_length = 1024
+    log_magnitudes = np.concatenate([
+        np.log1p(100 * np.abs(np.fft.rfft(windows[chunk_start:chunk_start + chunk_length] * window_function, axis=1))).astype(np.float32)
+        for chunk_start in range(0, len(windows), chunk_length)])
+
+    flux = np.maximum(0, np.diff(log_magnitudes, axis=0)).sum(axis=1)
+
+    return np.concatenate([[0], flux]).astype(np.float32)
+
+
+def estimate_beat_period(onset_strength: np.ndarray, frame_rate: int, hop_length: int = HOP_LENGTH,
+        min_bpm: float = 60, max_bpm: float = 180) -> Optional[float]:
+    """
+    Returns the beat period in hops, at sub-hop resolution, from the autocorrelation peak within the tempo range,
+    or None if the onset strength is too short to contain a single period.
+    """
+    # Smoothing, so that lags falling between the hops of sharp onsets still correlate
+    envelope = np.convolve(onset_strength, np.hanning(7), mode="same")
+    envelope -= envelope.mean()
+    spectrum = np.fft.rfft(envelope, 2 * len(envelope))
+    autocorrelation = np.fft.irfft(np.abs(spectrum) ** 2)[:len(envelope)]
+
+    hops_per_minute = 60 * frame_rate / hop_length
+    min_lag = max(1, int(hops_per_minute / max_bpm))
+    max_lag = min(len(envelope) - 2, int(np.ceil(hops_per_minute / min_bpm)))
+    if max_lag < min_lag:
+        return None
+
+    # Weighting lags by a log-normal prior around 120 BPM, as accents on every bar otherwise favor half the tempo
+    lags = np.arange(min_lag, max_lag + 1)
+    prior = np.exp(-.5 * np.log2(hops_per_minute / lags / PRIOR_BPM) ** 2)
+
+    lag = int(lags[np.argmax(autocorrelation[min_lag:max_lag + 1] * prior)])
+
+    # Parabolic interpolation around the peak
+    left, center, right = autocorrelation[lag - 1:lag + 2]
+    curvature = left - 2 * center + right
+
+    return lag + (.5 * (left - right) / curvature if curvature < 0 else 0.)
+
+
+def fit_beat_grid(onset_strength: np.ndarray, period: float, period_tolerance: float = 1.) -> Tuple[float, float]:
+    """
+    Returns phase and period (both in hops) of the constant-tempo grid with the highest onset strength on its beats,
+    searching periods within `period_tolerance` hops of `period`.
+    """
+    best_score, best_phase, best_period = -np.inf, 0., period
+
+    for candidate_period in period + np.linspace(-period_tolerance, period_tolerance, 201):
+        beat_count = int((len(onset_strength) - 1) / candidate_period)
+        if beat_count < 1:
+            continue
+
+        phases = np.arange(int(np.ceil(candidate_period)))
+        positions = np.rint(phases[:, np.newaxis] + candidate_period * np.arange(beat_count)).astype(int)
+        positions = np.minimum(positions, len(onset_strength) - 1)
+
+        scores = onset_strength[positions].sum(axis=1)
+        phase_id = int(np.argmax(scores))
+
+        if scores[phase_id] > best_score:
+            best_score, best_phase, best_period = scores[phase_id], float(phases[phase_id]), candidate_period
+
+    return best_phase, best_period
+
+
+def track_beats(onset_strength: np.ndarray, phase: float, period: float, max_deviation: float = .1) -> np.ndarray:
+    """
+    Returns the hops of the beats on the grid, each moved to the strongest onset within `max_deviation` periods.
+    """
+    beats = np.rint(np.arange(phase, len(onset_strength), period)).astype(int)
+
+    radius = max(1, int(max_deviation * period))
+    neighbourhoods = np.clip(beats[:, np.newaxis] + np.arange(-radius, radius + 1), 0, len(onset_strength) - 1)
+    strengths = onset_strength[neighbourhoods]
+    strongest = neighbourhoods[np.arange(len(beats)), np.argmax(strengths, axis=1)]
+
+    # Keeping beats without a stronger onset around on the grid
+    return np.where(strengths.max(axis=1) > onset_strength[beats], strongest, beats)
+
+
+def get_downbeats(onset_strength: np.ndarray, beats: np.ndarray, beats_per_bar: int = 4) -> np.ndarray:
+    bar_position = int(np.argmax([onset_strength[beats[position::beats_per_bar]].mean() for position in range(beats_per_bar)]))
+    return beats[bar_position::beats_per_bar]
+
+
+def analyze_beats(pcm: PcmBuffer, beats_per_bar: int = 4) -> Dict[str, Any]:
+    """
+    Returns tempo in BPM, beats and downbeats in ms of the song, as stored in the catalog.
+    """
+    no_beats = dict(tempo=None, beats=list(), downbeats=list())
+
+    onset_strength = get_onset_strength(pcm.samples)
+    if len(onset_strength) < 3:
+        return no_beats
+
+    period = estimate_beat_period(onset_strength, pcm.frame_rate)
+    if period is None:
+        return no_beats
+
+    phase, period = fit_beat_grid(onset_strength, period)
+    beats = track_beats(onset_strength, phase, period)
+    # Bar positions are told apart by their average onset strength, which needs a full bar
+    if len(beats) < beats_per_bar:
+        return no_beats
+
+    downbeats = get_downbeats(onset_strength, beats, beats_per_bar)
+
+    def to_ms(hops: np.ndarray) -> list:
+        # The flux at a hop stems from the samples that just entered the analysis window
+        return np.rint((hops * HOP_LENGTH + FRAME_LENGTH - HOP_LENGTH / 2) * 1000 / pcm.frame_rate).astype(int).tolist()
+
+    return dict(
+        tempo=round(60 * pcm.frame_rate / HOP_LENGTH / period, 2),
+        beats=to_ms(beats),
+        downbeats=to_ms(downbeats))
@@ -199,12 +199,11 @@ class TransitionCanvas():
         self.fig.savefig(path)
 
 
-    def resample_waveform(self, waveform_np_int: np.ndarray) -> np.ndarray:
+    def resample_waveform(self, waveform_np_int: np.ndarray, sample_rate_original: float = 44100.0) -> np.ndarray:
         waveform_np_f32 = (waveform_np_int / 255).astype(np.float32)
         waveform_tensor_f32 = torch.tensor(waveform_np_f32)          
 
         sample_rate_after_subsampling = 20.0
-        sample_rate_original = 44100.0
         # must be float32 and mono in order to be fast (otherwise factor 20 slower!)
         resampled_tensor_f32 = torchaudio.transforms.Resample(sample_rate_original, sample_rate_after_subsampling, 'sinc_interpolation')(waveform_tensor_f32)
         resampled_np_int = (resampled_tensor_f32 * 255).type(torch.int16).numpy().flatten()
@@ -215,11 +214,16 @@ class TransitionCanvas():
 
     
     def draw_segment(self, segment: AudioSegment, sample_marker: int = None):
+        self.draw_waveform(np.array(segment.get_array_of_samples())[::segment.channels], segment.frame_rate, sample_marker)
+
+    def draw_waveform(self, waveform_np_int: np.ndarray, sample_rate: float, sample_marker: int = None):
+        """
+        Draws the mono waveform `waveform_np_int` of integer samples taken at `sample_rate`, e. g. a decimated rendering of a mix.
+        """
         if self.waveform_line:
             self.waveform_ax.lines.remove(self.waveform_line)
 
-        segment = np.array(segment.get_array_of_samples())[::segment.channels]
-        idx, resampled_np_int = self.resample_waveform(segment)
+        idx, resampled_np_int = self.resample_waveform(waveform_np_int, sample_rate)
 
         x = idx
         y = resampled_np_int
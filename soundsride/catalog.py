@@ -0,0 +1,121 @@
+"""
+The song library is described by a single JSON catalog, which looks like
+
+{
+    "format": {"frame_rate": <Hz>, "channels": <count>, "sample_width": <bytes>},
+    "songs": {
+        "<song name>": {
+            "audio_file": "<path relative to the catalog>",
+            "phases": [[<start timestamp in ms>, "<genre>"], ...],
+            "duration": <ms>,
+            "loudness": <RMS in dBFS>, "block_loudness": [<RMS in dBFS of each second>, ...],
+            "content_hash": "<SHA-1 of the audio file>",
+            "tempo": <BPM>, "beats": [<ms>, ...], "downbeats": [<ms>, ...]
+        },
+        ...
+    },
+    "transition_types": {
+        "<transition type>": {"song": "<song name>", "genres": ["<pre transition genre>", "<post transition genre>"]},
+        "<transition type>": {"song": "<song name>", "end_to_end": <transition timestamp in ms>},
+        ...
+    }
+}
+
+All songs are decoded to the single canonical format given under "format" when they are ingested.
+Audio properties are null until the catalog is updated with the audio files present, see `update_catalog`.
+Snippet bounds are not stored, as they follow from the phase boundaries and the duration.
+"""
+
+import json
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Any, Dict, List
+
+import fire
+
+from .beats import analyze_beats
+from .loudness import measure_loudness, measure_block_loudness
+from .mixer import CANONICAL_CHANNELS, CANONICAL_FRAME_RATE, CANONICAL_SAMPLE_WIDTH
+from . import pcm_cache
+
+# The library directory holds the catalog, the audio files are given relative to it
+LIBRARY_DIR = Path(os.environ.get("SOUNDSRIDE_LIBRARY_DIR", "./tests/data/"))
+CATALOG_FILE = LIBRARY_DIR / "catalog.json"
+
+
+def read_catalog(catalog_file: Path) -> Dict[str, Any]:
+    return json.loads(Path(catalog_file).read_text())
+
+
+def write_catalog(catalog_file: Path, catalog: Dict[str, Any]):
+    catalog_json = json.dumps(catalog, indent=4)
+    # Keeping each phase and each list of beats on a single line
+    catalog_json = re.sub(r"\[\s+(-?\d+),\s+(\"[^\"]*\")\s+\]", r"[\1, \2]", catalog_json)
+    catalog_json = re.sub(r"\[\s+((?:-?[\d.]+,\s+)*-?[\d.]+)\s+\]", lambda match: "[" + re.sub(r",\s+", ", ", match.group(1)) + "]", catalog_json)
+
+    Path(catalog_file).write_text(catalog_json + "\n")
+
+
+def read_phases(metadata_file: Path) -> List[List[Any]]:
+    """
+    Reads a metadata file of `<start timestamp in ms> <genre>` lines as used before the catalog.
+    """
+    phases = list()
+
+    for line in Path(metadata_file).read_text().splitlines(keepends=False):
+        if not line.strip():
+            continue
+
+        phase_start_timestamp, phase_genre = line.split()
+        phases.append([int(phase_start_timestamp), phase_genre])
+
+    return phases
+
+
+def analyze_audio_file(audio_file: Path) -> Dict[str, Any]:
+    content_hash = pcm_cache.get_content_hash(audio_file)
+    pcm = pcm_cache.load_pcm(audio_file, content_hash=content_hash)
+
+    return dict(
+        duration=len(pcm),
+        loudness=round(measure_loudness(pcm.samples), 2),
+        block_loudness=measure_block_loudness(pcm.samples, pcm.frame_rate),
+        content_hash=content_hash,
+        **analyze_beats(pcm))
+
+
+def update_catalog(catalog_file: Path, analyze: bool = True) -> Dict[str, Any]:
+    """
+    Adds the songs with a metadata file next to the catalog that are missing from it
+    and fills in the audio properties of all songs whose audio file is present.
+    """
+    catalog_file = Path(catalog_file)
+    catalog = read_catalog(catalog_file) if catalog_file.exists() else dict(format=None, songs=dict(), transition_types=dict())
+
+    for metadata_file in sorted(catalog_file.parent.glob("*.txt")):
+        audio_file = metadata_file.with_suffix(".mp3")
+        if metadata_file.stem not in catalog["songs"] and audio_file.exists():
+            catalog["songs"][metadata_file.stem] = dict(
+                audio_file=audio_file.name, phases=read_phases(metadata_file),
+                duration=None, loudness=None, block_loudness=None, content_hash=None,
+                tempo=None, beats=None, downbeats=None)
+
+    catalog["format"] = dict(frame_rate=CANONICAL_FRAME_RATE, channels=CANONICAL_CHANNELS, sample_width=CANONICAL_SAMPLE_WIDTH)
+
+    for song_name, song_entry in catalog["songs"].items():
+        audio_file = catalog_file.parent / song_entry["audio_file"]
+
+        if analyze and audio_file.exists():
+            logging.getLogger(__name__).info("Analyzing %s", song_name)
+            song_entry.update(analyze_audio_file(audio_file))
+
+    write_catalog(catalog_file, catalog)
+
+    return catalog
+
+
+if __name__ == "__main__":
+    # python -m soundsride.catalog tests/data/catalog.json
+    fire.Fire(update_catalog)
@@ -0,0 +1,46 @@
+from typing import Callable, Dict
+
+import numpy as np
+
+LOGARITHMIC_FADE_RANGE_DB = 60.
+
+def _logarithmic(progress: np.ndarray) -> np.ndarray:
+    # Linear in dB from -LOGARITHMIC_FADE_RANGE_DB to 0 dB, shifted and scaled to start at silence
+    floor = 10 ** (-LOGARITHMIC_FADE_RANGE_DB / 20)
+    return (10 ** (LOGARITHMIC_FADE_RANGE_DB * (progress - 1) / 20) - floor) / (1 - floor)
+
+FADE_CURVES: Dict[str, Callable[[np.ndarray], np.ndarray]] = {
+    # Constant amplitude sum, the pydub default, dips in loudness in the middle of a crossfade of uncorrelated songs
+    "linear": lambda progress: progress,
+    # Constant power sum, that is sin² + cos² = 1, for crossfades without loudness dip
+    "equal_power": lambda progress: np.sin(progress * np.pi / 2),
+    "logarithmic": _logarithmic,
+    # Raised cosine, starting and ending smoothly for long fades
+    "s_curve": lambda progress: .5 - .5 * np.cos(progress * np.pi),
+}
+
+FADE_CURVE_BY_TRANSITION_MODE: Dict[str, str] = {
+    "EARLY": "equal_power",
+    "MEDIUM": "equal_power",
+    "LATE": "equal_power",
+    "SLOW": "s_curve",
+}
+
+
+def get_fade_curve_by_transition_mode(transition_mode: str) -> str:
+    return FADE_CURVE_BY_TRANSITION_MODE.get(transition_mode, "linear")
+
+
+def fade_in_gain(progress: np.ndarray, curve: str = "linear") -> np.ndarray:
+    """
+    Returns the gain for the given fade-in progress, with 0 at the start and 1 at the end of the fade.
+    Progress outside of [0, 1] is clipped, so that frames before the fade are silent and frames after it are untouched.
+    """
+    return FADE_CURVES[curve](np.clip(progress, 0, 1)).astype(np.float32)
+
+
+def fade_out_gain(progress: np.ndarray, curve: str = "linear") -> np.ndarray:
+    """
+    Returns the gain for the given fade-out progress, mirroring `fade_in_gain`.
+    """
+    return fade_in_gain(1 - progress, curve)
@@ -0,0 +1,149 @@
+"""
+The song library of the server, reloaded while it is running.
+
+A `LibraryManager` polls the modification times of the catalog and the audio files it refers to.
+When any of them changes, the catalog is read again, new or changed songs are analyzed and decoded
+and the result is published as a new `SongDatabase` snapshot, all in a background thread.
+Sessions keep the snapshot they started with, so they never wait for ingest or see songs change during a ride.
+"""
+
+import copy
+import logging
+from pathlib import Path
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from . import pcm_cache
+from .catalog import CATALOG_FILE, analyze_audio_file, read_catalog
+from .song import SongDatabase
+
+
+class LibraryManager:
+    """
+    Holds the current snapshot of the song library in `snapshot` and replaces it when the library changes.
+    Snapshots are never modified after they are published, publishing is a single reference assignment.
+    """
+
+    def __init__(self, catalog_file: Path = CATALOG_FILE, poll_interval: float = 5.) -> None:
+        self.catalog_file = Path(catalog_file)
+        self.poll_interval = poll_interval
+
+        # Modification times of the catalog and the present audio files when the snapshot was built
+        self._mtimes: Dict[Path, int] = self._get_mtimes(read_catalog(self.catalog_file))
+        # Audio file -> modification time and catalog content hash it was checked at, and the audio properties overriding the catalog
+        self._audio_properties: Dict[Path, Tuple[int, Optional[str], Dict[str, Any]]] = dict()
+
+        # The catalog is trusted for the initial snapshot, which decodes its songs on first use as before
+        self.snapshot = SongDatabase(self.catalog_file)
+
+        self._stop = threading.Event()
+        self._thread: threading.Thread = None
+
+    def _get_audio_file(self, song_entry: Dict[str, Any]) -> Path:
+        return self.catalog_file.parent / song_entry["audio_file"]
+
+    def _get_mtimes(self, catalog: Dict[str, Any]) -> Dict[Path, int]:
+        paths = [self.catalog_file] + [self._get_audio_file(song_entry) for song_entry in catalog["songs"].values()]
+        return {path: path.stat().st_mtime_ns for path in paths if path.exists()}
+
+    def _get_audio_properties(self, song_entry: Dict[str, Any], mtime: int) -> Dict[str, Any]:
+        """
+        Returns the audio properties of the song's audio file that differ from its catalog entry,
+        analyzing the file if it was changed without updating the catalog.
+        """
+        audio_file = self._get_audio_file(song_entry)
+        checked_mtime, checked_content_hash, audio_properties = self._audio_properties.get(audio_file, (None, None, dict()))
+
+        if (checked_mtime, checked_content_hash) != (mtime, song_entry.get("content_hash")):
+            if pcm_cache.get_content_hash(audio_file) == song_entry.get("content_hash"):
+                audio_properties = dict()
+            else:
+                logging.getLogger(__name__).info("Analyzing %s", audio_file)
+                audio_properties = analyze_audio_file(audio_file)
+
+            self._audio_properties[audio_file] = (mtime, song_entry.get("content_hash"), audio_properties)
+
+        return audio_properties
+
+    def reload(self) -> SongDatabase:
+        """
+        Builds a snapshot of the library as it is on disk now, loads it completely and publishes it.
+        Songs that did not change are taken over from the current snapshot.
+        """
+        catalog = read_catalog(self.catalog_file)
+        mtimes = self._get_mtimes(catalog)
+
+        catalog = copy.deepcopy(catalog)
+        for song_entry in catalog["songs"].values():
+            audio_file = self._get_audio_file(song_entry)
+            if audio_file in mtimes and mtimes[audio_file] != self._mtimes.get(audio_file):
+                song_entry.update(self._get_audio_properties(song_entry, mtimes[audio_file]))
+            elif audio_file in self._audio_properties:
+                song_entry.update(self._audio_properties[audio_file][2])
+
+        snapshot = SongDatabase(self.catalog_file, catalog, previous=self.snapshot)
+
+        # Decoding and indexing here, so that sessions starting with this snapshot don't have to
+        for transition_type in snapshot.get_transition_types():
+            snapshot.get_candidates_by_transition_type(transition_type)
+
+        self._mtimes = mtimes
+        self.snapshot = snapshot
+
+        logging.getLogger(__name__).info("Published library snapshot with %s songs", len(snapshot.song_database))
+
+        return snapshot
+
+    def poll(self) -> bool:
+        """
+        Reloads the library if the catalog or any of its audio files changed since the last snapshot.
+        """
+        mtimes = self._get_mtimes(read_catalog(self.catalog_file))
+        if mtimes == self._mtimes:
+            return False
+
+        self.reload()
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception: # pylint: disable=broad-except
+                # The current snapshot stays published, the library is tried again on the next poll
+                logging.getLogger(__name__).exception("Failed to reload library from %s", self.catalog_file)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="library-manager", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+_library_manager: LibraryManager = None
+_library_manager_lock = threading.Lock()
+
+def get_library_manager() -> LibraryManager:
+    """
+    Returns the library manager shared by all sessions of this process.
+    """
+    global _library_manager # pylint: disable=global-statement
+
+    with _library_manager_lock:
+        if _library_manager is None:
+            _library_manager = LibraryManager()
+
+        return _library_manager
+
+
+def get_song_database() -> SongDatabase:
+    """
+    Returns the current snapshot of the song library. Callers keep it for as long as they need a consistent library.
+    """
+    return get_library_manager().snapshot
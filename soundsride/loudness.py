@@ -0,0 +1,64 @@
+from typing import List, Optional
+
+import numpy as np
+
+# Songs are normalized to this RMS level
+TARGET_LOUDNESS = -20.
+# Quiet songs are not amplified beyond this, so that their peaks don't clip
+MAX_NORMALIZATION_GAIN_DB = 12.
+
+# The catalog stores the loudness of each song in blocks of this length,
+# so that the loudness of any snippet follows from a few numbers instead of a pass over its samples
+LOUDNESS_BLOCK_LENGTH = 1_000
+
+SILENCE = -120.
+
+
+def measure_loudness(samples: np.ndarray) -> float:
+    """
+    Returns the RMS level of the float32 `samples` in dBFS.
+    """
+    if not samples.size:
+        return SILENCE
+
+    mean_square = float(np.mean(np.square(samples, dtype=np.float64)))
+    return max(SILENCE, 10 * np.log10(max(mean_square, 1e-12)))
+
+
+def measure_block_loudness(samples: np.ndarray, frame_rate: int, block_length: int = LOUDNESS_BLOCK_LENGTH) -> List[float]:
+    """
+    Returns the RMS level in dBFS of each block of `block_length` ms, the last block being shorter.
+    """
+    if not len(samples):
+        return list()
+
+    samples = samples.reshape(len(samples), -1)
+    frame_squares = np.einsum("ij,ij->i", samples, samples, dtype=np.float64) / samples.shape[1]
+
+    block_starts = np.arange(0, len(samples), int(block_length * frame_rate / 1000))
+    block_sizes = np.diff(np.append(block_starts, len(samples)))
+    mean_squares = np.add.reduceat(frame_squares, block_starts) / block_sizes
+
+    return np.maximum(SILENCE, 10 * np.log10(np.maximum(mean_squares, 1e-12))).round(2).tolist()
+
+
+def combine_block_loudness(block_loudness: List[float], start: int, end: int, block_length: int = LOUDNESS_BLOCK_LENGTH) -> Optional[float]:
+    """
+    Returns the RMS level in dBFS between `start` and `end` ms from the levels of the blocks they cover.
+    """
+    blocks = np.asarray(block_loudness[start // block_length:-(-end // block_length)], dtype=np.float64)
+    if not len(blocks):
+        return None
+
+    return float(10 * np.log10(np.mean(10 ** (blocks / 10))))
+
+
+def get_normalization_gain(loudness: Optional[float], target_loudness: float = TARGET_LOUDNESS) -> float:
+    """
+    Returns the linear gain bringing `loudness` (in dBFS) to `target_loudness`, or 1 if the loudness is unknown.
+    """
+    if loudness is None:
+        return 1.
+
+    gain_db = min(MAX_NORMALIZATION_GAIN_DB, target_loudness - loudness)
+    return float(10 ** (gain_db / 20))
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Tuple,  Optional
+from typing import Any, Dict, Iterable, Iterator, List, Tuple,  Optional
 from dataclasses import dataclass
 import time
 import datetime
@@ -14,6 +14,9 @@ from rich.table import Table
 import plotly.graph_objects as go
 
 from .song import SongSnippet
+from .mixer import Mixer, PcmBuffer, ms_to_frames, frames_to_ms, convert_frames, array_to_segment
+from .fades import fade_in_gain, fade_out_gain, get_fade_curve_by_transition_mode
+from .snippet_cache import SnippetRenderCache, snippet_render_cache
 
 from .service.soundsride_service_pb2 import UpdateTransitionSpecRequest
 
@@ -21,19 +24,56 @@ class InvalidFadingOperationException(Exception): pass
 class TransitionTimeNegativeException(Exception): pass
 
 class ScheduledSnippet:
+    """
+    A song snippet placed on the mix plan's timeline. 
+
+    All positions are kept as frame indices at the song's frame rate, so that cuts and fades land on exact samples
+    and the renderer can index the PCM directly. The millisecond accessors are derived from them.
+    """
+
     def __init__(self, song_snippet: SongSnippet, scheduled_transition_time: int, transition_mode: str):
         if scheduled_transition_time <= 0:
             raise TransitionTimeNegativeException()
 
         self.song_snippet = song_snippet
-        self.scheduled_transition_time = scheduled_transition_time
+        self.frame_rate = song_snippet.frame_rate
+        self.scheduled_transition_frame = ms_to_frames(scheduled_transition_time, self.frame_rate)
 
         self.transition_mode = transition_mode
         
-        self._fade_in_min = None
-        self._fade_in_max = None
-        self._fade_out_min = None
-        self._fade_out_max = None
+        self._fade_in_min_frame = None
+        self._fade_in_max_frame = None
+        self._fade_out_min_frame = None
+        self._fade_out_max_frame = None
+
+        self._fade_in_curve = "linear"
+        self._fade_out_curve = "linear"
+
+    def _to_ms(self, frames: Optional[int]) -> Optional[int]:
+        return None if frames is None else frames_to_ms(frames, self.frame_rate)
+
+    def _to_frames(self, ms: Optional[int]) -> Optional[int]:
+        return None if ms is None else ms_to_frames(ms, self.frame_rate)
+
+    @property
+    def scheduled_transition_time(self) -> int:
+        return self._to_ms(self.scheduled_transition_frame)
+
+    @property
+    def _fade_in_min(self) -> Optional[int]:
+        return self._to_ms(self._fade_in_min_frame)
+
+    @property
+    def _fade_in_max(self) -> Optional[int]:
+        return self._to_ms(self._fade_in_max_frame)
+
+    @property
+    def _fade_out_min(self) -> Optional[int]:
+        return self._to_ms(self._fade_out_min_frame)
+
+    @property
+    def _fade_out_max(self) -> Optional[int]:
+        return self._to_ms(self._fade_out_max_frame)
 
     def get_snippet_offset(self):
         return self.get_scheduled_transition() - self.song_snippet.get_pre_transition_duration()
@@ -44,102 +84,328 @@ class ScheduledSnippet:
     def snippet_time_to_mix_plan_time(self, snippet_time: int) -> int:
         return snippet_time + self.get_snippet_offset()
 
+    def get_nearest_downbeat(self, mix_plan_time: int, min_time: int, max_time: int) -> Optional[int]:
+        """
+        Returns the time within the mix plan of the song's downbeat closest to `mix_plan_time`, 
+        if there is one between `min_time` and `max_time`.
+        """
+        downbeats = self.song_snippet.downbeats
+        if downbeats is None or not len(downbeats):
+            return None
+
+        song_time_offset = self.song_snippet.genre_transition_timestamp - self.get_scheduled_transition()
+        downbeat_id = int(np.searchsorted(downbeats, mix_plan_time + song_time_offset))
+
+        candidates = [
+            int(downbeat) - song_time_offset for downbeat in downbeats[max(0, downbeat_id - 1):downbeat_id + 1]
+            if min_time <= int(downbeat) - song_time_offset <= max_time]
+
+        if not candidates:
+            # The closest downbeats lie outside the bounds, so do all others
+            return None
+
+        return min(candidates, key=lambda candidate: abs(candidate - mix_plan_time))
+
+    def get_scheduled_transition_frame(self) -> int:
+        return self.scheduled_transition_frame
+
+    def get_earliest_start_frame(self) -> int:
+        return max(0, self.scheduled_transition_frame - self.song_snippet.get_pre_transition_frames())
+
+    def get_latest_end_frame(self) -> int:
+        return self.scheduled_transition_frame + self.song_snippet.get_post_transition_frames()
+
+    def get_scheduled_start_frame(self, frame_rate: int = None) -> int:
+        """
+        Returns the first scheduled frame, at the snippet's frame rate unless `frame_rate` is given.
+        """
+        start_frame = self.get_earliest_start_frame() if self._fade_in_min_frame is None else self._fade_in_min_frame
+
+        return convert_frames(start_frame, self.frame_rate, frame_rate or self.frame_rate)
+
+    def get_scheduled_end_frame(self, frame_rate: int = None) -> int:
+        """
+        Returns the frame after the last scheduled one, at the snippet's frame rate unless `frame_rate` is given.
+        """
+        end_frame = self.get_latest_end_frame() if self._fade_out_max_frame is None else self._fade_out_max_frame
+
+        return convert_frames(end_frame, self.frame_rate, frame_rate or self.frame_rate)
+
     def get_scheduled_transition(self):
-        return self.scheduled_transition_time
+        return self._to_ms(self.get_scheduled_transition_frame())
 
     def get_earliest_start(self):
-        return max(0, self.scheduled_transition_time - self.song_snippet.get_pre_transition_duration())
+        return self._to_ms(self.get_earliest_start_frame())
     
     def get_latest_end(self):
-        return self.scheduled_transition_time + self.song_snippet.get_post_transition_duration()
+        return self._to_ms(self.get_latest_end_frame())
 
     def get_scheduled_start(self):
-        if self._fade_in_min is None:
-            return self.get_earliest_start()
-        
-        return self._fade_in_min
+        return self._to_ms(self.get_scheduled_start_frame())
 
     def get_scheduled_end(self):
-        if self._fade_out_max is None:
-            return self.get_latest_end()
+        return self._to_ms(self.get_scheduled_end_frame())
 
-        return self._fade_out_max
+    def _get_base_pcm(self, frame_rate: int, channels: int) -> PcmBuffer:
+        return self.song_snippet.base_pcm.as_format(frame_rate, channels)
+
+    def _get_song_frame_range(self, base_pcm: PcmBuffer) -> Tuple[int, int]:
+        """
+        Returns the frames of `base_pcm` between which the scheduled part of the snippet lies.
+        """
+        def to_song_frame(frame: int) -> int:
+            song_frame = self.song_snippet.genre_transition_frame + frame - self.scheduled_transition_frame
+            return min(base_pcm.frame_count(), convert_frames(song_frame, self.frame_rate, base_pcm.frame_rate))
+
+        return to_song_frame(self.get_scheduled_start_frame()), to_song_frame(self.get_scheduled_end_frame())
 
     def get_audio_segment(self):
-        base_snippet = self.song_snippet.get_audio_segment()
-    
-        snippet_relative_start = self.song_snippet.get_pre_transition_duration() - (
-            self.get_scheduled_transition() - self.get_scheduled_start())
+        base_pcm = self.song_snippet.base_pcm
+        samples = self.get_rendered_samples(base_pcm.frame_rate, base_pcm.channels)
 
-        snippet_relative_end = self.song_snippet.get_pre_transition_duration() + (
-            self.get_scheduled_end() - self.get_scheduled_transition())
+        return array_to_segment(samples, base_pcm.frame_rate, base_pcm.sample_width)
 
-        segment = base_snippet[snippet_relative_start:snippet_relative_end] 
+    def get_frame_count(self, frame_rate: int) -> int:
+        song_start_frame, song_end_frame = self._get_song_frame_range(
+            self._get_base_pcm(frame_rate, self.song_snippet.base_pcm.channels))
+        return song_end_frame - song_start_frame
 
-        assert (self._fade_in_min is None) == (self._fade_in_max is None)
-        assert (self._fade_out_max is None) == (self._fade_out_min is None)
+    def _get_fade_frames(self, n_frames: int, frame_rate: int) -> Tuple[int, int]:
+        assert (self._fade_in_min_frame is None) == (self._fade_in_max_frame is None)
+        assert (self._fade_out_max_frame is None) == (self._fade_out_min_frame is None)
 
-        if not self._fade_in_min is None:
-            fade_in_duration = self._fade_in_max - self._fade_in_min
-            if fade_in_duration:
-                segment = segment.fade_in(fade_in_duration)
-    
-        if not self._fade_out_min is None:
-            fade_out_duration = self._fade_out_max - self._fade_out_min
-            if fade_out_duration:
-                segment = segment.fade_out(fade_out_duration)
+        fade_in_frames = 0
+        if self._fade_in_min_frame is not None:
+            fade_in_frames = min(n_frames, convert_frames(self._fade_in_max_frame - self._fade_in_min_frame, self.frame_rate, frame_rate))
+
+        fade_out_frames = 0
+        if self._fade_out_min_frame is not None:
+            fade_out_frames = min(n_frames, convert_frames(self._fade_out_max_frame - self._fade_out_min_frame, self.frame_rate, frame_rate))
 
-        return segment
+        return fade_in_frames, fade_out_frames
 
-    def set_fade_in(self, min_ts: int, max_ts: int):
+    def get_gain_envelope(self, n_frames: int, frame_rate: int, start: int = 0, end: int = None) -> Optional[np.ndarray]:
+        """
+        Returns the per-frame gain for frames `start` to `end` of the snippet's `n_frames` scheduled frames
+        as a float32 array or None if the snippet is neither faded in nor faded out.
+        The gain follows the fade curves set with `set_fade_in` and `set_fade_out`, 
+        scaled by the snippet's loudness normalization gain.
+        """
+        if end is None:
+            end = n_frames
+
+        fade_in_frames, fade_out_frames = self._get_fade_frames(n_frames, frame_rate)
+
+        if not fade_in_frames and not fade_out_frames:
+            return None
+
+        frames = np.arange(start, end, dtype=np.float64)
+        envelope = np.full(end - start, self.get_normalization_gain(), dtype=np.float32)
+
+        if fade_in_frames:
+            envelope *= fade_in_gain(frames / fade_in_frames, self._fade_in_curve)
+
+        if fade_out_frames:
+            envelope *= fade_out_gain((frames - (n_frames - fade_out_frames)) / fade_out_frames, self._fade_out_curve)
+
+        return envelope
+
+    def get_normalization_gain(self) -> float:
+        return self.song_snippet.get_normalization_gain()
+
+    def get_samples(self, frame_rate: int, channels: int, start: int = 0, end: int = None) -> np.ndarray:
+        """
+        Returns the unfaded float32 samples for frames `start` to `end` of the scheduled part of the snippet
+        in the given format. This is a view of the song's PCM, no samples are copied.
+        """
+        base_pcm = self._get_base_pcm(frame_rate, channels)
+        song_start_frame, song_end_frame = self._get_song_frame_range(base_pcm)
+
+        if end is None:
+            end = song_end_frame - song_start_frame
+
+        return base_pcm.samples[song_start_frame + start:song_start_frame + end]
+
+    def get_fade_geometry(self) -> Tuple:
+        """
+        Describes the scheduled snippet by song, snippet bounds and fade geometry.
+        All timestamps are taken relative to the scheduled transition, 
+        so that a snippet that is just shifted in time keeps its geometry.
+        """
+        transition = self.scheduled_transition_frame
+
+        def relative(frame):
+            return None if frame is None else frame - transition
+
+        return (
+            self.song_snippet.base_pcm.identity,
+            self.song_snippet.snippet_start_frame,
+            self.song_snippet.genre_transition_frame,
+            self.song_snippet.snippet_end_frame,
+            relative(self.get_scheduled_start_frame()),
+            relative(self.get_scheduled_end_frame()),
+            relative(self._fade_in_min_frame),
+            relative(self._fade_in_max_frame),
+            relative(self._fade_out_min_frame),
+            relative(self._fade_out_max_frame),
+            self._fade_in_curve,
+            self._fade_out_curve,
+            self.get_normalization_gain())
+
+    def get_render_key(self, frame_rate: int, channels: int) -> Tuple:
+        return self.get_fade_geometry() + (frame_rate, channels)
+
+    def _get_part_ranges(self, n_frames: int, frame_rate: int) -> List[Tuple[int, int, bool]]:
+        """
+        Splits the snippet's `n_frames` scheduled frames into (start, end, faded) ranges: 
+        the faded regions at its start and its end and the unfaded frames in between.
+        """
+        fade_in_frames, fade_out_frames = self._get_fade_frames(n_frames, frame_rate)
+
+        if fade_in_frames + fade_out_frames >= n_frames:
+            part_ranges = [(0, n_frames, True)]
+        else:
+            part_ranges = [
+                (0, fade_in_frames, True), 
+                (fade_in_frames, n_frames - fade_out_frames, False), 
+                (n_frames - fade_out_frames, n_frames, True)]
+
+        return [(start, end, faded) for start, end, faded in part_ranges if start < end]
+
+    def get_part_signatures(self, frame_rate: int, channels: int) -> List[Tuple[int, int, Tuple]]:
+        """
+        Returns the parts `get_rendered_parts` renders as (start frame, end frame, signature) within the mix, without rendering them.
+
+        Parts of equal signature render to the same samples wherever they overlap:
+        unfaded parts are views of the song, identified by song, the song's offset within the mix and the gain,
+        faded parts are identified by their exact range and the fades they cover in addition.
+        """
+        base_pcm = self._get_base_pcm(frame_rate, channels)
+        song_start_frame, song_end_frame = self._get_song_frame_range(base_pcm)
+        n_frames = song_end_frame - song_start_frame
+        fade_in_frames, fade_out_frames = self._get_fade_frames(n_frames, frame_rate)
+
+        snippet_start = self.get_scheduled_start_frame(frame_rate)
+        view = (self.song_snippet.base_pcm.identity, song_start_frame - snippet_start, self.get_normalization_gain())
+
+        part_signatures = list()
+        for start, end, faded in self._get_part_ranges(n_frames, frame_rate):
+            signature = view
+            if faded:
+                # The fade curves are clipped outside of the fades, so a faded region only depends on the fades it overlaps
+                fade_in = (fade_in_frames, self._fade_in_curve) if start < fade_in_frames else None
+                fade_out = (snippet_start + n_frames - fade_out_frames, fade_out_frames, self._fade_out_curve) \
+                    if end > n_frames - fade_out_frames else None
+                signature = view + (snippet_start + start, snippet_start + end, fade_in, fade_out)
+
+            part_signatures.append((snippet_start + start, snippet_start + end, signature))
+
+        return part_signatures
+
+    def get_rendered_parts(self, frame_rate: int, channels: int, cache: SnippetRenderCache = None) -> List[Tuple[int, np.ndarray, float]]:
+        """
+        Returns the rendered snippet as list of (frame offset, samples, gain) parts: 
+        the faded regions at its start and its end, which are looked up in `cache` if given, 
+        and in between a view of the unfaded samples of the song.
+
+        The loudness normalization is folded into the fade envelope of the faded regions, 
+        while the view is to be scaled by its `gain` when it is added to the mix.
+        """
+        samples = self.get_samples(frame_rate, channels)
+        n_frames = len(samples)
+
+        parts = list()
+        for start, end, faded in self._get_part_ranges(n_frames, frame_rate):
+            if not faded:
+                parts.append((start, samples[start:end], self.get_normalization_gain()))
+                continue
+
+            key = self.get_render_key(frame_rate, channels) + (start, end)
+            faded_samples = cache.get(key) if cache is not None else None
+
+            if faded_samples is None:
+                faded_samples = samples[start:end] * self.get_gain_envelope(n_frames, frame_rate, start, end)[:, np.newaxis]
+                if cache is not None:
+                    faded_samples = cache.put(key, faded_samples)
+
+            parts.append((start, faded_samples, 1.))
+
+        return parts
+
+    def get_rendered_samples(self, frame_rate: int, channels: int, cache: SnippetRenderCache = None) -> np.ndarray:
+        """
+        Returns the faded float32 samples of the scheduled part of the snippet as one contiguous array.
+        """
+        parts = self.get_rendered_parts(frame_rate, channels, cache)
+        if not parts:
+            return np.zeros((0, channels), dtype=np.float32)
+
+        return np.concatenate([samples * np.float32(gain) if gain != 1. else samples for _, samples, gain in parts])
+
+    def set_fade_in(self, min_ts: int, max_ts: int, curve: str = "linear"):
         """
         Snippet will be 
         - set to volume 0% before min_ts
-        - faded in linearly between min_ts and max_ts
+        - faded in along `curve` (one of `fades.FADE_CURVES`, linearly by default) between min_ts and max_ts
         - set to volume 100% after max_ts
 
         Timestamps are relative to the schedule's origin.
 
         To have the snippet kick-in without a fade-in effect, set min_ts and max_ts to the same timestamp.
         """
-        if min_ts is not None and min_ts < self.get_earliest_start():
-            min_ts = self.get_earliest_start()
+        self.set_fade_in_frames(self._to_frames(min_ts), self._to_frames(max_ts), curve)
+
+    def set_fade_in_frames(self, min_frame: int, max_frame: int, curve: str = "linear"):
+        """
+        Like `set_fade_in`, but with frame indices at the snippet's frame rate.
+        """
+        if min_frame is not None and min_frame < self.get_earliest_start_frame():
+            min_frame = self.get_earliest_start_frame()
             # raise InvalidFadingOperationException(f"min_ts ({min_ts}) must be equal to or lie after earliest start ({self.get_earliest_start()}).")
 
-        if max_ts is not None and max_ts > self.get_latest_end():
-            max_ts = self.get_latest_end()
+        if max_frame is not None and max_frame > self.get_latest_end_frame():
+            max_frame = self.get_latest_end_frame()
             # raise InvalidFadingOperationException("min_ts must be equal to or lie before latest end.")
 
-        if min_ts and self._fade_out_min and self._fade_out_min < min_ts:
+        if min_frame and self._fade_out_min_frame and self._fade_out_min_frame < min_frame:
             raise InvalidFadingOperationException("min_ts must lie before fade_out_min")
 
-        self._fade_in_min = min_ts
-        self._fade_in_max = max_ts
+        self._fade_in_min_frame = min_frame
+        self._fade_in_max_frame = max_frame
+        self._fade_in_curve = curve
 
-    def set_fade_out(self, min_ts: int, max_ts: int):
+    def set_fade_out(self, min_ts: int, max_ts: int, curve: str = "linear"):
         """
         Snippet will be 
         - set to volume 100% before min_ts
-        - faded out linearly between min_ts and max_ts
+        - faded out along `curve` (one of `fades.FADE_CURVES`, linearly by default) between min_ts and max_ts
         - set to volume 0% after max_ts
 
         Timestamps are relative to the schedule's origin.
 
         To have the snippet be muted without a fade-out effect, set min_ts and max_ts to the same timestamp.
         """
+        self.set_fade_out_frames(self._to_frames(min_ts), self._to_frames(max_ts), curve)
 
+    def set_fade_out_frames(self, min_frame: int, max_frame: int, curve: str = "linear"):
+        """
+        Like `set_fade_out`, but with frame indices at the snippet's frame rate.
+        """
+        if min_frame is not None and min_frame < self.get_earliest_start_frame():
+            raise InvalidFadingOperationException(
+                f"min_ts  ({self._to_ms(min_frame)})  must be equal to or lie after earliest start ({self.get_earliest_start()}).")
 
-        if min_ts is not None and min_ts < self.get_earliest_start():
-            raise InvalidFadingOperationException(f"min_ts  ({min_ts})  must be equal to or lie after earliest start ({self.get_earliest_start()}).")
-
-        if max_ts is not None and max_ts > self.get_latest_end():
-            raise InvalidFadingOperationException(f"max_ts ({max_ts}) must be equal to or lie before latest end ({self.get_latest_end()}).")
+        if max_frame is not None and max_frame > self.get_latest_end_frame():
+            raise InvalidFadingOperationException(
+                f"max_ts ({self._to_ms(max_frame)}) must be equal to or lie before latest end ({self.get_latest_end()}).")
 
-        if min_ts and self._fade_in_max and self._fade_in_max > min_ts:
-            raise InvalidFadingOperationException(f"min_ts must ({min_ts}) lie after fade_in_max ({self._fade_in_max})")
+        if min_frame and self._fade_in_max_frame and self._fade_in_max_frame > min_frame:
+            raise InvalidFadingOperationException(
+                f"min_ts must ({self._to_ms(min_frame)}) lie after fade_in_max ({self._fade_in_max})")
 
-        self._fade_out_min = min_ts
-        self._fade_out_max = max_ts
+        self._fade_out_min_frame = min_frame
+        self._fade_out_max_frame = max_frame
+        self._fade_out_curve = curve
 
     def extend(self, required_post_transition_length: int, extension_strategy: str = "auto"):
         raise NotImplementedError
@@ -446,6 +712,7 @@ class MixPlan:
         self.transition_safe_zone_length = 5_000
         self.cross_fade_duration = 3_000
         self.long_cross_fade_duration = 25_000
+        self.snippet_render_cache: Optional[SnippetRenderCache] = snippet_render_cache
 
     @property
     def scheduled_snippets(self) -> List[ScheduledSnippet]:
@@ -569,17 +836,136 @@ class MixPlan:
         last_scheduled_snippet = self.scheduled_snippets[-1]
         return last_scheduled_snippet.get_scheduled_end()
 
+    def get_length_frames(self, frame_rate: int) -> int:
+        """
+        Returns the end of the last snippet as frame index at `frame_rate`
+        """
+        return self.scheduled_snippets[-1].get_scheduled_end_frame(frame_rate)
+
+    def get_format(self) -> Tuple[int, int, int]:
+        """
+        Returns frame rate, channel count and sample width of the rendered mix.
+        As with `AudioSegment.overlay`, the richest format among the scheduled snippets wins.
+        """
+        base_pcms = [scheduled_snippet.song_snippet.base_pcm for scheduled_snippet in self.scheduled_snippets]
+
+        frame_rate = max(base_pcm.frame_rate for base_pcm in base_pcms)
+        channels = max(base_pcm.channels for base_pcm in base_pcms)
+        sample_width = max(base_pcm.sample_width for base_pcm in base_pcms)
+
+        return frame_rate, channels, sample_width
+
+    def to_mixer(self, start_ms: int = 0, end_ms: int = None) -> Mixer:
+        """
+        Renders the part of the mix between `start_ms` and `end_ms` (defaulting to the whole mix).
+        Only snippets overlapping this window are rendered. 
+        Their unfaded parts are added straight from the songs' PCM, 
+        their faded parts are taken from `snippet_render_cache` if available.
+        """
+        frame_rate = self.get_format()[0]
+
+        start_frame = ms_to_frames(start_ms, frame_rate)
+        end_frame = ms_to_frames(end_ms, frame_rate) if end_ms is not None else self.get_length_frames(frame_rate)
+
+        return self.to_mixer_frames(start_frame, end_frame)
+
+    def to_mixer_frames(self, start_frame: int, end_frame: int) -> Mixer:
+        """
+        Like `to_mixer`, but with frame indices at the mix's frame rate.
+        """
+        frame_rate, channels, sample_width = self.get_format()
+        mixer = Mixer(end_frame - start_frame, frame_rate, channels, sample_width)
 
-    def to_audio_segment(self):
-        segment = AudioSegment.silent(self.get_length())
-        # print("Silent segment has ", len(segment), " ms")
-        
         for scheduled_snippet in self.scheduled_snippets:
-            segment = segment.overlay(scheduled_snippet.get_audio_segment(), position=scheduled_snippet.get_scheduled_start())
+            snippet_start = scheduled_snippet.get_scheduled_start_frame(frame_rate)
+            if snippet_start >= end_frame or scheduled_snippet.get_scheduled_end_frame(frame_rate) <= start_frame:
+                continue
+
+            for part_start, samples, gain in self._get_rendered_parts(scheduled_snippet, frame_rate, channels):
+                if part_start < end_frame and part_start + len(samples) > start_frame:
+                    mixer.add(samples, part_start - start_frame, gain=gain)
+
+        return mixer
+
+    def _get_rendered_parts(self, scheduled_snippet: ScheduledSnippet, frame_rate: int, channels: int) -> List[Tuple[int, np.ndarray, float]]:
+        """
+        Returns the rendered parts of `scheduled_snippet` with their start frames within the mix.
+        """
+        snippet_start = scheduled_snippet.get_scheduled_start_frame(frame_rate)
 
+        return [
+            (snippet_start + offset, samples, gain) 
+            for offset, samples, gain in scheduled_snippet.get_rendered_parts(frame_rate, channels, self.snippet_render_cache)]
+
+    def iter_blocks(self, start_ms: int = 0, block_frames: int = 11_025) -> Iterator[np.ndarray]:
+        """
+        Yields the mix from `start_ms` on as consecutive float32 blocks of shape (block_frames, channels), 
+        the last block being shorter if the mix ends within it.
+
+        Each block only sums the snippet parts active within it, so the full mix is never materialized 
+        and memory stays constant regardless of the mix's length.
+        """
+        frame_rate, channels, sample_width = self.get_format()
+        end_frame = self.get_length_frames(frame_rate)
+        position = ms_to_frames(start_ms, frame_rate)
+
+        parts = sorted(
+            (part for scheduled_snippet in self.scheduled_snippets
+                for part in self._get_rendered_parts(scheduled_snippet, frame_rate, channels)
+                if part[0] + len(part[1]) > position),
+            key=lambda part: part[0])
+
+        active_parts = list()
+        next_part_id = 0
+
+        while position < end_frame:
+            block_end = min(position + block_frames, end_frame)
+
+            while next_part_id < len(parts) and parts[next_part_id][0] < block_end:
+                active_parts.append(parts[next_part_id])
+                next_part_id += 1
+
+            active_parts = [part for part in active_parts if part[0] + len(part[1]) > position]
+
+            mixer = Mixer(block_end - position, frame_rate, channels, sample_width)
+            for part_start, samples, gain in active_parts:
+                mixer.add(samples, part_start - position, gain=gain)
+
+            yield mixer.buffer
+
+            position = block_end
+
+    def render_decimated(self, step_frames: int) -> np.ndarray:
+        """
+        Renders every `step_frames`-th frame of the mix as float32 array of shape (frames, channels), e. g. to plot its waveform.
+        Only these frames are summed from the snippet parts, which is about `step_frames` times cheaper than rendering the mix.
+        """
+        frame_rate, channels, sample_width = self.get_format()
+        mixer = Mixer(-(-self.get_length_frames(frame_rate) // step_frames), frame_rate // step_frames, channels, sample_width)
+
+        for scheduled_snippet in self.scheduled_snippets:
+            for part_start, samples, gain in self._get_rendered_parts(scheduled_snippet, frame_rate, channels):
+                # Skipping to the first frame of the part that is rendered
+                offset = -part_start % step_frames
+                mixer.add(samples[offset::step_frames], (part_start + offset) // step_frames, gain=gain)
+
+        return mixer.buffer
+
+    def render_window(self, start_ms: int, end_ms: int) -> np.ndarray:
+        """
+        Renders the mix between `start_ms` and `end_ms` as float32 array of shape (frames, channels).
+        """
+        return self.to_mixer(start_ms, end_ms).buffer
+
+    def to_array(self) -> np.ndarray:
+        """
+        Renders the mix as float32 array of shape (frames, channels).
+        """
+        return self.to_mixer().buffer
+
+    def to_audio_segment(self):
         # segment.export(datetime.datetime.fromtimestamp(time.time()).isoformat().replace(":", "-") + ".mp3")
-        
-        return segment
+        return self.to_mixer().to_audio_segment()
 
     # Transitioning
     def _get_overlap_zones(self) -> List[Optional[Tuple[int, int]]]: # pylint: disable=unsubscriptable-object
@@ -615,8 +1001,18 @@ class MixPlan:
         return overlap_zones
 
     def _get_best_cut_candidate(self, ending_snippet, starting_snippet, overlap_zone_start, overlap_zone_end) -> int:
-        cut_candidates = [int((overlap_zone_start + overlap_zone_end) / 2)]
-        return cut_candidates[0]
+        """
+        Cuts at the downbeat of the starting snippet closest to the middle of the overlap zone, 
+        falling back to the ending snippet's downbeats and to the middle itself if the songs weren't analyzed.
+        """
+        middle = int((overlap_zone_start + overlap_zone_end) / 2)
+
+        for scheduled_snippet in [starting_snippet, ending_snippet]:
+            downbeat = scheduled_snippet.get_nearest_downbeat(middle, overlap_zone_start, overlap_zone_end)
+            if downbeat is not None:
+                return downbeat
+
+        return middle
 
     def _get_cross_fade_zone_candidate(self, 
             first_snippet: ScheduledSnippet, 
@@ -700,6 +1096,15 @@ class MixPlan:
             fade_zone_start = transition_zone_start
             fade_zone_end = fade_zone_start + self.cross_fade_duration
 
+        # Shifting the fade, so that the starting snippet is fully faded in on a downbeat
+        downbeat = second_snippet.get_nearest_downbeat(
+            fade_zone_end, 
+            transition_zone_start + (fade_zone_end - fade_zone_start), 
+            max(transition_zone_end, fade_zone_end))
+
+        if downbeat is not None:
+            fade_zone_start, fade_zone_end = fade_zone_start + downbeat - fade_zone_end, downbeat
+
         logging.getLogger(__name__).debug("Fade zone starts at %s and ends at %s", fade_zone_start, fade_zone_end)            
 
         return fade_zone_start, fade_zone_end
@@ -757,8 +1162,57 @@ class MixPlan:
             else:
                 raise ValueError("transition_type invalid")
                 
-            ending_snippet.set_fade_out(fade_out_start, fade_out_end)
-            starting_snippet.set_fade_in(fade_in_start, fade_in_end)
+            # Both sides of a crossfade follow the curve chosen for the starting snippet's transition mode
+            fade_curve = get_fade_curve_by_transition_mode(starting_snippet.transition_mode)
+            ending_snippet.set_fade_out(fade_out_start, fade_out_end, fade_curve)
+            starting_snippet.set_fade_in(fade_in_start, fade_in_end, fade_curve)
+
+    def get_dirty_intervals(self, previous_mix_plan: Optional["MixPlan"]) -> List[Tuple[int, int]]:
+        """
+        Diffs this mix plan against `previous_mix_plan` and returns the time ranges in which the rendered mixes differ.
+
+        The snippets are diffed by their rendered parts, so that moving a transition only dirties the fades that moved
+        and the parts of the views they uncover or cover, while views that were just extended or shortened stay clean.
+        """
+        if not self.scheduled_snippets:
+            return list()
+
+        if previous_mix_plan is None or not previous_mix_plan.scheduled_snippets:
+            return [(0, self.get_length())]
+
+        if previous_mix_plan.get_format() != self.get_format():
+            return [(0, max(self.get_length(), previous_mix_plan.get_length()))]
+
+        frame_rate, channels, _ = self.get_format()
+
+        # Per signature the frames its parts cover, counted up for this plan and down for the previous one
+        coverage_changes: Dict[Tuple, List[Tuple[int, int]]] = dict()
+        for mix_plan, sign in [(self, 1), (previous_mix_plan, -1)]:
+            for scheduled_snippet in mix_plan.scheduled_snippets:
+                for start, end, signature in scheduled_snippet.get_part_signatures(frame_rate, channels):
+                    coverage_changes.setdefault(signature, list()).extend([(start, sign), (end, -sign)])
+
+        # The mixes differ wherever a signature covers frames a different number of times
+        changed_ranges = list()
+        for changes in coverage_changes.values():
+            changes.sort()
+            coverage = 0
+            for (frame, change), (next_frame, _) in zip(changes, changes[1:]):
+                coverage += change
+                if coverage and frame < next_frame:
+                    changed_ranges.append((frame, next_frame))
+
+        # Rounding outwards to whole milliseconds, so that the intervals cover all frames that differ
+        changed_ranges = sorted((start * 1000 // frame_rate, -(-end * 1000 // frame_rate)) for start, end in changed_ranges)
+
+        dirty_intervals = list()
+        for start, end in changed_ranges:
+            if dirty_intervals and start <= dirty_intervals[-1][1]:
+                dirty_intervals[-1] = (dirty_intervals[-1][0], max(end, dirty_intervals[-1][1]))
+            else:
+                dirty_intervals.append((start, end))
+
+        return dirty_intervals
 
     # For Snippet Starts and Ends
 
@@ -868,9 +1322,9 @@ class MixPlanViz:
         samples = samples[0]
 
         # print("original len(samples)", len(samples))
-        # print("original frame_rate", scheduled_snippet.song_snippet.base_audio_segment.frame_rate)
+        # print("original frame_rate", scheduled_snippet.song_snippet.base_pcm.frame_rate)
         
-        number_of_samples = round(len(samples) * float(self.visualized_sample_rate) / scheduled_snippet.song_snippet.base_audio_segment.frame_rate)
+        number_of_samples = round(len(samples) * float(self.visualized_sample_rate) / scheduled_snippet.song_snippet.base_pcm.frame_rate)
         samples = sps.resample(samples, number_of_samples)
 
         samples = samples / np.max(samples)
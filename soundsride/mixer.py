@@ -0,0 +1,373 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+import logging
+from math import gcd
+import threading
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+
+import numpy as np
+from pydub import AudioSegment
+from scipy.linalg.blas import saxpy
+from scipy.signal import resample_poly
+
+if TYPE_CHECKING:
+    from .mix_plan import MixPlan
+
+# Songs are converted to this format once when they are ingested,
+# so that mixing never converts per render and all rendered mixes can be swapped into the player
+CANONICAL_FRAME_RATE = 44_100
+CANONICAL_CHANNELS = 2
+CANONICAL_SAMPLE_WIDTH = 2
+
+# Frames scaled at a time where samples cannot be accumulated by BLAS, which bounds the scratch buffer
+GAIN_CHUNK_FRAMES = 4096
+
+# Identities of buffers that are not backed by a PCM cache entry, which unlike ids are never reused
+_buffer_identities = count()
+
+
+def ms_to_frames(ms: int, frame_rate: int) -> int:
+    # Truncating like pydub does when slicing, so that frame positions match the previous overlay-based rendering
+    return int(ms * frame_rate / 1000)
+
+
+def frames_to_ms(frames: int, frame_rate: int) -> int:
+    # Rounding, so that converting whole milliseconds to frames and back is lossless
+    return round(frames * 1000 / frame_rate)
+
+
+def convert_frames(frames: int, from_frame_rate: int, to_frame_rate: int) -> int:
+    if from_frame_rate == to_frame_rate:
+        return frames
+
+    return round(frames * to_frame_rate / from_frame_rate)
+
+
+def segment_to_array(segment: AudioSegment) -> np.ndarray:
+    """
+    Returns the segment's PCM as a float32 array of shape (frames, channels) with values in [-1, 1).
+    """
+    dtype = {1: np.int8, 2: np.int16, 4: np.int32}[segment.sample_width]
+    samples = np.frombuffer(segment.raw_data, dtype=dtype).astype(np.float32)
+    samples /= float(1 << (8 * segment.sample_width - 1))
+
+    return samples.reshape(-1, segment.channels)
+
+
+def array_to_segment(samples: np.ndarray, frame_rate: int, sample_width: int = 2) -> AudioSegment:
+    """
+    Converts a float32 array of shape (frames, channels) back into an AudioSegment, clipping at full scale.
+    """
+    dtype = {1: np.int8, 2: np.int16, 4: np.int32}[sample_width]
+    max_value = float(1 << (8 * sample_width - 1))
+
+    pcm = np.clip(samples * max_value, -max_value, max_value - 1).astype(dtype)
+
+    return AudioSegment(
+        pcm.tobytes(),
+        frame_rate=frame_rate,
+        sample_width=sample_width,
+        channels=samples.shape[1])
+
+
+def convert_format(samples: np.ndarray, from_frame_rate: int, frame_rate: int, channels: int) -> np.ndarray:
+    """
+    Returns the float32 `samples` of shape (frames, channels) resampled to `frame_rate` and mixed to `channels`.
+    Resampling is polyphase filtering, which is worth its cost as songs are converted only once.
+    """
+    if samples.shape[1] != channels:
+        mono = samples if samples.shape[1] == 1 else samples.mean(axis=1, keepdims=True, dtype=np.float32)
+        samples = np.repeat(mono, channels, axis=1)
+
+    if from_frame_rate != frame_rate:
+        divisor = gcd(from_frame_rate, frame_rate)
+        samples = resample_poly(samples, frame_rate // divisor, from_frame_rate // divisor, axis=0)
+
+    return np.ascontiguousarray(samples, dtype=np.float32)
+
+
+class PcmBuffer:
+    """
+    Decoded float32 PCM of shape (frames, channels), held once per song and shared by all of its snippets.
+    Snippets only keep frame offsets into it and hand out views, so no samples are copied before the final mix write.
+    """
+
+    def __init__(self, samples: np.ndarray, frame_rate: int, sample_width: int = 2, identity: str = None) -> None:
+        self.samples = samples
+        self.frame_rate = frame_rate
+        self.sample_width = sample_width
+        # Identifies the song's PCM in render cache keys, the PCM cache key for buffers loaded from the PCM cache
+        self.identity = identity if identity is not None else f"buffer-{next(_buffer_identities)}"
+        self._converted: Dict[Tuple[int, int], "PcmBuffer"] = dict()
+
+    @staticmethod
+    def from_audio_segment(segment: AudioSegment) -> "PcmBuffer":
+        return PcmBuffer(segment_to_array(segment), segment.frame_rate, segment.sample_width)
+
+    @property
+    def channels(self) -> int:
+        return self.samples.shape[1]
+
+    def frame_count(self) -> int:
+        return len(self.samples)
+
+    def __len__(self) -> int:
+        # In milliseconds, like AudioSegment
+        return round(1000 * self.frame_count() / self.frame_rate)
+
+    def ms_to_frames(self, ms: int) -> int:
+        return min(self.frame_count(), max(0, ms_to_frames(ms, self.frame_rate)))
+
+    def get_frames(self, start_frame: int, end_frame: int) -> np.ndarray:
+        return self.samples[max(0, start_frame):end_frame]
+
+    def as_format(self, frame_rate: int, channels: int) -> "PcmBuffer":
+        """
+        Returns this buffer converted to the given format. Conversions are done once and kept for later calls.
+        """
+        if (frame_rate, channels) == (self.frame_rate, self.channels):
+            return self
+
+        if (frame_rate, channels) not in self._converted:
+            samples = convert_format(self.samples, self.frame_rate, frame_rate, channels)
+            self._converted[(frame_rate, channels)] = PcmBuffer(samples, frame_rate, self.sample_width)
+
+        return self._converted[(frame_rate, channels)]
+
+    def to_canonical(self) -> "PcmBuffer":
+        """
+        Returns this buffer in the canonical format all songs are ingested in, without keeping the conversion.
+        """
+        if (self.frame_rate, self.channels, self.sample_width) == (CANONICAL_FRAME_RATE, CANONICAL_CHANNELS, CANONICAL_SAMPLE_WIDTH):
+            return self
+
+        samples = convert_format(self.samples, self.frame_rate, CANONICAL_FRAME_RATE, CANONICAL_CHANNELS)
+        return PcmBuffer(samples, CANONICAL_FRAME_RATE, CANONICAL_SAMPLE_WIDTH)
+
+    def to_audio_segment(self, start: int = 0, end: int = None) -> AudioSegment:
+        return array_to_segment(self.samples[start:end], self.frame_rate, self.sample_width)
+
+
+class Mixer:
+    """
+    Sums snippets into a single preallocated float32 output buffer.
+
+    In contrast to chaining `AudioSegment.overlay`, which copies the whole mix for every snippet,
+    each snippet is written exactly once and conversion to the playback format happens only once at the end.
+    """
+
+    def __init__(self, n_frames: int, frame_rate: int, channels: int, sample_width: int = 2) -> None:
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.buffer = np.zeros((n_frames, channels), dtype=np.float32)
+
+    def add(self, samples: np.ndarray, position: int, envelope: Optional[np.ndarray] = None, gain: float = 1.):
+        """
+        Adds `samples` at frame `position`, scaled by the per-frame gain `envelope` if given, or else by the scalar `gain`.
+        Samples exceeding the buffer are dropped, matching `AudioSegment.overlay`, 
+        which also applies to samples before the buffer start for negative positions.
+        """
+        if position < 0:
+            samples = samples[-position:]
+            envelope = envelope[-position:] if envelope is not None else None
+            position = 0
+
+        n_frames = max(0, min(len(samples), len(self.buffer) - position))
+        if not n_frames:
+            return
+
+        target = self.buffer[position:position + n_frames]
+
+        if envelope is None and gain == 1.:
+            target += samples[:n_frames]
+        elif envelope is None:
+            self._add_scaled(samples[:n_frames], target, gain)
+        else:
+            target += samples[:n_frames] * envelope[:n_frames, np.newaxis]
+
+    @staticmethod
+    def _add_scaled(samples: np.ndarray, target: np.ndarray, gain: float):
+        """
+        Adds `samples` scaled by `gain` to `target` in place, without a temporary copy of the scaled samples.
+        """
+        if samples.dtype == np.float32 and samples.flags.c_contiguous:
+            # Rows of the buffer are contiguous, so BLAS updates the buffer through the flat view
+            saxpy(samples.reshape(-1), target.reshape(-1), a=gain)
+            return
+
+        scratch = np.empty((min(len(samples), GAIN_CHUNK_FRAMES), samples.shape[1]), dtype=np.float32)
+        for start in range(0, len(samples), GAIN_CHUNK_FRAMES):
+            chunk = scratch[:len(samples) - start]
+            np.multiply(samples[start:start + GAIN_CHUNK_FRAMES], np.float32(gain), out=chunk)
+            target[start:start + len(chunk)] += chunk
+
+    def to_audio_segment(self) -> AudioSegment:
+        return array_to_segment(self.buffer, self.frame_rate, self.sample_width)
+
+
+class WindowedMixSegment:
+    """
+    Stands in for the fully rendered AudioSegment of a mix plan, 
+    but renders the mix lazily in windows of `window_length` ms as playback moves forward.
+
+    Supports what the `Player` needs from an AudioSegment: `len`, slicing by milliseconds and the format attributes,
+    as well as reading frames by index with `get_frames` like a `PcmBuffer`.
+    Whenever a window is accessed, the next window is rendered in the background, until the segment is retired.
+
+    If the segment of the previous mix plan is passed as `previous`, windows already rendered for it are reused
+    and only the time ranges in which the mix plans differ are re-rendered into them.
+    """
+
+    def __init__(self, mix_plan: "MixPlan", window_length: int = 10_000, previous: "WindowedMixSegment" = None) -> None:
+        self.mix_plan = mix_plan
+        self.window_length = window_length
+        self.frame_rate, self.channels, self.sample_width = mix_plan.get_format()
+        self.frame_width = self.channels * self.sample_width
+
+        self._length = mix_plan.get_length()
+        self._windows: Dict[int, np.ndarray] = dict()
+        self._lock = threading.Lock()
+
+        # Each segment prefetches on a thread of its own, so that windows of a replaced segment don't delay those of its successor
+        self._prefetch_executor = ThreadPoolExecutor(1, thread_name_prefix=type(self).__name__)
+        self._retired = False
+
+        # Only the rendered windows are taken over to avoid keeping the chain of all previous segments alive
+        self._previous_windows: Dict[int, np.ndarray] = dict()
+        self.dirty_intervals: List[Tuple[int, int]] = [(0, self._length)]
+
+        if previous is not None and previous.window_length == window_length:
+            self.dirty_intervals = mix_plan.get_dirty_intervals(previous.mix_plan)
+            with previous._lock: # pylint: disable=protected-access
+                self._previous_windows = dict(previous._windows) # pylint: disable=protected-access
+
+            logging.getLogger(__name__).debug(
+                "Dirty intervals are %s, %s previously rendered windows available", self.dirty_intervals, len(self._previous_windows))
+
+    def __len__(self) -> int:
+        return self._length
+
+    def get_number_of_windows(self) -> int:
+        return -(-self._length // self.window_length)
+
+    def _get_window(self, window_id: int) -> np.ndarray:
+        window = self._windows.get(window_id)
+        if window is not None:
+            return window
+
+        # Rendering happens outside of the lock so that playback never waits for a prefetch of another window
+        window_start = window_id * self.window_length
+        window_end = min(self._length, (window_id + 1) * self.window_length)
+        window = self._patch_previous_window(window_id, window_start, window_end)
+
+        if window is None:
+            logging.getLogger(__name__).debug("Rendering window %s", window_id)
+            window = self.mix_plan.render_window(window_start, window_end)
+
+        with self._lock:
+            return self._windows.setdefault(window_id, window)
+
+    def _patch_previous_window(self, window_id: int, window_start: int, window_end: int) -> Optional[np.ndarray]:
+        previous_window = self._previous_windows.pop(window_id, None)
+        if previous_window is None:
+            return None
+
+        window_origin = ms_to_frames(window_start, self.frame_rate)
+        if len(previous_window) != ms_to_frames(window_end, self.frame_rate) - window_origin:
+            return None
+
+        dirty_intervals = [
+            (max(window_start, dirty_start), min(window_end, dirty_end))
+            for dirty_start, dirty_end in self.dirty_intervals
+            if dirty_start < window_end and dirty_end > window_start]
+
+        if not dirty_intervals:
+            logging.getLogger(__name__).debug("Reusing window %s", window_id)
+            return previous_window
+
+        logging.getLogger(__name__).debug("Patching window %s in %s", window_id, dirty_intervals)
+        window = previous_window.copy()
+
+        for dirty_start, dirty_end in dirty_intervals:
+            patch = self.mix_plan.render_window(dirty_start, dirty_end)
+            patch_start = ms_to_frames(dirty_start, self.frame_rate) - window_origin
+            window[patch_start:patch_start + len(patch)] = patch
+
+        return window
+
+    def _prefetch_window(self, window_id: int):
+        with self._lock:
+            if not self._retired and window_id < self.get_number_of_windows() and window_id not in self._windows:
+                self._prefetch_executor.submit(self._get_window, window_id)
+
+    def retire(self):
+        """
+        Stops prefetching once the segment was replaced in the player, dropping prefetches that did not start yet.
+        Windows can still be read, e. g. for the crossfade into the replacing segment, but are only rendered on access.
+        """
+        with self._lock:
+            self._retired = True
+
+        self._prefetch_executor.shutdown(wait=False, cancel_futures=True)
+
+    def prefetch(self, start_ms: int, duration: int = None):
+        """
+        Synchronously renders the windows covering `duration` ms (defaulting to `window_length`) from `start_ms` on.
+        """
+        if duration is None:
+            duration = self.window_length
+
+        start_ms = max(0, min(start_ms, self._length - 1))
+        end_ms = min(self._length, start_ms + duration)
+
+        for window_id in range(start_ms // self.window_length, -(-end_ms // self.window_length)):
+            self._get_window(window_id)
+
+    def frame_count(self) -> int:
+        return ms_to_frames(self._length, self.frame_rate)
+
+    def _get_window_origin(self, window_id: int) -> int:
+        return ms_to_frames(window_id * self.window_length, self.frame_rate)
+
+    def _get_window_id(self, frame: int) -> int:
+        window_id = frame * 1000 // (self.window_length * self.frame_rate)
+        # Window origins are truncated to frames, so a frame right at an origin may belong to the next window
+        while self._get_window_origin(window_id + 1) <= frame:
+            window_id += 1
+
+        return window_id
+
+    def get_frames(self, start_frame: int, end_frame: int) -> np.ndarray:
+        """
+        Returns the mix between the frame indices `start_frame` and `end_frame`, rendering the windows it lies in if necessary.
+        """
+        start_frame, end_frame = max(0, start_frame), min(self.frame_count(), end_frame)
+        if start_frame >= end_frame:
+            return np.zeros((0, self.channels), dtype=np.float32)
+
+        first_window_id = self._get_window_id(start_frame)
+        last_window_id = self._get_window_id(end_frame - 1)
+
+        if first_window_id == last_window_id:
+            samples = self._get_window(first_window_id)
+        else:
+            samples = np.concatenate([self._get_window(window_id) for window_id in range(first_window_id, last_window_id + 1)])
+
+        self._prefetch_window(last_window_id + 1)
+
+        window_origin = self._get_window_origin(first_window_id)
+
+        return samples[start_frame - window_origin:end_frame - window_origin]
+
+    def get_array(self, start_ms: int, end_ms: int) -> np.ndarray:
+        return self.get_frames(ms_to_frames(max(0, start_ms), self.frame_rate), ms_to_frames(min(self._length, end_ms), self.frame_rate))
+
+    def __getitem__(self, millisecond: slice) -> AudioSegment:
+        start = millisecond.start if millisecond.start is not None else 0
+        end = millisecond.stop if millisecond.stop is not None else self._length
+
+        return array_to_segment(self.get_array(start, end), self.frame_rate, self.sample_width)
+
+    def to_audio_segment(self) -> AudioSegment:
+        return self[0:self._length]
@@ -0,0 +1,134 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+from pydub import AudioSegment
+
+from .mixer import CANONICAL_CHANNELS, CANONICAL_FRAME_RATE, PcmBuffer
+
+PCM_CACHE_DIR = Path(os.environ.get("SOUNDSRIDE_PCM_CACHE_DIR", "./.pcm_cache/"))
+
+
+def decode(audio_file: Path) -> PcmBuffer:
+    """
+    Returns the PCM of `audio_file` in the canonical format.
+    """
+    return PcmBuffer.from_audio_segment(AudioSegment.from_file(str(audio_file))).to_canonical()
+
+
+def get_cache_key(content_hash: str) -> str:
+    # Including the format, so that entries decoded to another canonical format are not mistaken for current ones
+    return f"{content_hash}-{CANONICAL_FRAME_RATE}-{CANONICAL_CHANNELS}"
+
+
+def get_content_hash(path: Path) -> str:
+    content_hash = hashlib.sha1()
+
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            content_hash.update(chunk)
+
+    return content_hash.hexdigest()
+
+
+def read_cached_pcm(key: str, cache_dir: Path = PCM_CACHE_DIR) -> Optional[PcmBuffer]:
+    """
+    Returns the PCM cached under `key` memory-mapped read-only, or None if there is none.
+    Mapping instead of reading makes loading instant and lets processes on the same host share the pages.
+    """
+    samples_file = cache_dir / f"{key}.npy"
+    format_file = cache_dir / f"{key}.json"
+
+    if not samples_file.exists():
+        return None
+
+    pcm_format = json.loads(format_file.read_text())
+    samples = np.load(samples_file, mmap_mode="r")
+
+    return PcmBuffer(samples, pcm_format["frame_rate"], pcm_format["sample_width"], identity=key)
+
+
+def write_cached_pcm(key: str, pcm: PcmBuffer, cache_dir: Path = PCM_CACHE_DIR):
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    # The samples file is moved into place last, as its existence marks a complete entry
+    (cache_dir / f"{key}.json").write_text(json.dumps(dict(frame_rate=pcm.frame_rate, sample_width=pcm.sample_width)))
+
+    temporary_file = cache_dir / f"{key}.{os.getpid()}.tmp.npy"
+    np.save(temporary_file, pcm.samples)
+    os.replace(temporary_file, cache_dir / f"{key}.npy")
+
+
+def load_pcm(audio_file: Path, cache_dir: Optional[Path] = PCM_CACHE_DIR, content_hash: str = None) -> PcmBuffer:
+    """
+    Returns the decoded PCM of `audio_file`, from the cache in `cache_dir` if the file was decoded before.
+    Entries are keyed by the file's content hash, so changed files are decoded again. Pass None to bypass the cache.
+    If the content hash is already known, e. g. from the catalog, it can be passed to skip reading the file.
+    """
+    if cache_dir is None:
+        return decode(audio_file)
+
+    key = get_cache_key(content_hash or get_content_hash(audio_file))
+
+    pcm = read_cached_pcm(key, cache_dir)
+    if pcm is not None:
+        logging.getLogger(__name__).debug("Loaded %s from PCM cache", audio_file)
+        return pcm
+
+    logging.getLogger(__name__).info("Decoding %s into PCM cache", audio_file)
+    pcm = decode(audio_file)
+    pcm.identity = key
+    write_cached_pcm(key, pcm, cache_dir)
+
+    return pcm
+
+
+def _ingest_file(audio_file: Path, cache_dir: Path) -> Tuple[Path, float, bool]:
+    start = time.perf_counter()
+
+    key = get_cache_key(get_content_hash(audio_file))
+    was_cached = (cache_dir / f"{key}.npy").exists()
+
+    if not was_cached:
+        write_cached_pcm(key, decode(audio_file), cache_dir)
+
+    return audio_file, time.perf_counter() - start, was_cached
+
+
+def ingest(audio_files: Iterable[Path], cache_dir: Path = PCM_CACHE_DIR, max_workers: int = None) -> Dict[Path, float]:
+    """
+    Decodes all `audio_files` missing from the PCM cache in a process pool of at most one worker per core,
+    so that a cold start scales with the number of cores rather than the number of songs.
+    Workers only write to the cache, the decoded samples are then memory-mapped by `load_pcm` instead of being sent back.
+
+    Returns the time in seconds spent on each file.
+    """
+    audio_files = list(audio_files)
+    if not audio_files:
+        return dict()
+
+    max_workers = min(len(audio_files), max_workers or os.cpu_count() or 1)
+    durations: Dict[Path, float] = dict()
+
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(_ingest_file, audio_file, cache_dir) for audio_file in audio_files]
+
+        for future in as_completed(futures):
+            audio_file, duration, was_cached = future.result()
+            durations[audio_file] = duration
+
+            logging.getLogger(__name__).info(
+                "Ingested %s in %.2f s%s", audio_file, duration, " (cached)" if was_cached else "")
+
+    logging.getLogger(__name__).info(
+        "Ingested %s files in %.2f s with %s workers", len(audio_files), time.perf_counter() - start, max_workers)
+
+    return durations
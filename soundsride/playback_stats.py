@@ -0,0 +1,80 @@
+from bisect import bisect_left
+import json
+import logging
+from pathlib import Path
+from typing import Any, Dict, List
+
+# Upper bounds of the histogram buckets in ms, the last bucket takes everything above
+HISTOGRAM_BOUNDS = [.1, .2, .5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1_000]
+
+
+class Histogram:
+    """
+    Counts values in fixed buckets, so that recording a value from the audio callback is a bisect and an increment.
+    """
+
+    def __init__(self, bounds: List[float] = None) -> None:
+        self.bounds = bounds or HISTOGRAM_BOUNDS
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def get_stats(self) -> Dict[str, Any]:
+        labels = [f"<={bound}" for bound in self.bounds] + [f">{self.bounds[-1]}"]
+
+        return dict(
+            count=self.count,
+            mean=self.total / self.count if self.count else None,
+            max=self.max,
+            buckets={label: count for label, count in zip(labels, self.counts) if count})
+
+
+class PlaybackStats:
+    """
+    Measurements of a playback, to tell whether and why it glitched and to tune lookahead and buffer sizes.
+
+    The sink's callback records callback durations, fill levels, underruns and swap latencies,
+    the feeder thread records overruns. Each value is only written by one thread, so no locks are taken,
+    and other threads may read slightly inconsistent stats while playback is running.
+    """
+
+    def __init__(self) -> None:
+        # Time spent in the sink's callback in ms
+        self.callback_durations = Histogram()
+        # Audio buffered ahead of the playhead at each callback in ms
+        self.fill_levels = Histogram()
+        # Time from a segment being swapped in until its first frame is output in ms
+        self.swap_latencies = Histogram()
+
+        # Callbacks that had to play silence for frames that were not rendered in time
+        self.underruns = 0
+        self.underrun_frames = 0
+        # Rendered frames that did not fit into the ring buffer
+        self.overruns = 0
+        self.overrun_frames = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        return dict(
+            underruns=self.underruns,
+            underrun_frames=self.underrun_frames,
+            overruns=self.overruns,
+            overrun_frames=self.overrun_frames,
+            callback_durations=self.callback_durations.get_stats(),
+            fill_levels=self.fill_levels.get_stats(),
+            swap_latencies=self.swap_latencies.get_stats())
+
+    def log_stats(self):
+        logging.getLogger(__name__).info(
+            "Playback: %s underruns (%s frames), %s overruns (%s frames), callbacks take %.2f ms at most, swaps are heard after %s ms at most",
+            self.underruns, self.underrun_frames, self.overruns, self.overrun_frames,
+            self.callback_durations.max, round(self.swap_latencies.max, 1))
+
+    def write(self, stats_file: Path):
+        Path(stats_file).write_text(json.dumps(self.get_stats(), indent=4))
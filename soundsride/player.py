@@ -1,77 +1,251 @@
-from os import stat
+import threading
 import time
-from typing import Literal, Union
+from pathlib import Path
+from typing import Any, Dict, Literal, Optional, Tuple, Union
 
+import numpy as np
 from pydub import AudioSegment
-from pyaudio import PyAudio, Stream
 from concurrent.futures import ThreadPoolExecutor, Future
 import fire
 
+from .fades import fade_in_gain, fade_out_gain
+from .mixer import PcmBuffer, frames_to_ms, ms_to_frames
+from .playback_stats import PlaybackStats
+from .ring_buffer import RingBuffer
+from .sinks import AudioSink, PyAudioSink, create_sink
+
+# The mix is rendered this many ms ahead of the playhead, so that rendering hiccups don't cause underruns
+LEAD_TIME = 200
+# Swapped segments are crossfaded over this many ms, as jumping between them at the same position clicks
+SWAP_CROSSFADE_DURATION = 10
+# Playback stats are written this often in s during playback, if a stats file is given
+STATS_INTERVAL = 10
+
+
 class PlaybackState():
-    def __init__(self, sample_rate: int):
-        self.played_milliseconds = 0
+    def __init__(self, sample_rate: int, channels: int = 2, start_frame: int = 0):
         self.sample_rate: int = sample_rate
+        # The output is opened with this channel count and the sample rate, segments swapped in must match them
+        self.channels: int = channels
         self.playback_future: Future = None
         self.request_stop: bool = False
         self.state: Union[Literal["idle"], Literal["running"], Literal["finished"]] = \
             "idle" # pylint: disable=unsubscriptable-object
         self.swap_segment: AudioSegment = None
+        # When the latest segment was swapped in, to measure until it is heard
+        self.swap_time: Optional[float] = None
+        # Wakes up the thread filling the ring buffer, so that swaps and stops don't wait for its next round
+        self.changed = threading.Event()
+
+        # Start and end frame of the latest device buffer and the `time.perf_counter` time its start reaches the speakers.
+        # Set by the audio callback as a single tuple, so that other threads read a consistent clock without a lock
+        self._clock: Tuple[int, int, Optional[float]] = (start_frame, start_frame, None)
+
+        self.stats = PlaybackStats()
+
+    def update_clock(self, start_frame: int, end_frame: int, dac_time: float):
+        self._clock = (start_frame, end_frame, dac_time)
+
+    def get_sample_position(self) -> int:
+        """
+        Returns the frame being heard right now, interpolated from the latest device buffer and its output time.
+        """
+        start_frame, end_frame, dac_time = self._clock
+        if dac_time is None:
+            return start_frame
 
-    def get_sample_position(self):
-        return int(self.played_milliseconds / 1000 * self.sample_rate)
+        # Before the buffer's output time the previous buffer is still being heard, which this also covers
+        position = start_frame + int((time.perf_counter() - dac_time) * self.sample_rate)
+        return max(0, min(end_frame, position))
+
+    @property
+    def played_milliseconds(self) -> int:
+        return frames_to_ms(self.get_sample_position(), self.sample_rate)
+
+    def get_format(self) -> Tuple[int, int]:
+        """
+        Returns sample rate and channel count of the open output. Samples are output as float32 regardless of the segments' sample width.
+        """
+        return self.sample_rate, self.channels
+
+    def get_stats(self) -> Dict[str, Any]:
+        return self.stats.get_stats()
+
+    def swap(self, segment: AudioSegment):
+        self.swap_time = time.perf_counter()
+        self.swap_segment = segment
+        self.changed.set()
+
+    def stop(self):
+        self.request_stop = True
+        self.changed.set()
 
 
 class Player():
+    """
+    Plays a segment to `sink`, by default the sound card in PyAudio's callback mode (see `sinks`).
+    A feeder thread renders the segment into a ring buffer ahead of the playhead and the sink's callback only copies from it.
     
-    def __init__(self, segment: AudioSegment):
-        self._segment = segment
+    Swapping in another segment rewrites the buffered frames from the new segment, 
+    so the swap is heard after at most two device buffers instead of after everything buffered ahead.
+    The first `swap_crossfade_duration` ms are an equal power crossfade from the previous segment.
+
+    Underruns, latencies and buffer levels are recorded in the `PlaybackState.stats` and written to `stats_file` if given.
+    """
     
-    def play_stream(self) -> PlaybackState:
-        p = PyAudio()
-        
-        def playback_stream(segment: AudioSegment, playback_state: PlaybackState):
-            sample_format = p.get_format_from_width(segment.sample_width)
-            channels = segment.channels
-            rate = segment.frame_rate
+    def __init__(self, segment: AudioSegment, swap_crossfade_duration: int = SWAP_CROSSFADE_DURATION, sink: AudioSink = None,
+            stats_file: Path = None):
+        self._segment = segment
+        self.swap_crossfade_duration = swap_crossfade_duration
+        self.sink = sink or PyAudioSink()
+        self.stats_file = stats_file
+
+    @staticmethod
+    def _to_frame_source(segment: AudioSegment):
+        # Mixes are read by frame index, plain AudioSegments are decoded to PCM once for that
+        return PcmBuffer.from_audio_segment(segment) if isinstance(segment, AudioSegment) else segment
 
-            stream = p.open(format=sample_format, channels=channels, rate=rate, output=True)
+    @staticmethod
+    def get_swap_crossfade(previous_segment, segment, position: int, fade_in: np.ndarray, fade_out: np.ndarray) -> np.ndarray:
+        """
+        Returns the frames from `position` on crossfading from `previous_segment` to `segment` with the given gains.
+        Segments ending within the crossfade are padded with silence.
+        """
+        crossfade = np.zeros((len(fade_in), segment.channels), dtype=np.float32)
 
-            chunk_length = 250 # ms
-            playback_state.state = "running"
+        previous_samples = previous_segment.get_frames(position, position + len(fade_out))
+        samples = segment.get_frames(position, position + len(fade_in))
+
+        crossfade[:len(previous_samples)] = previous_samples * fade_out[:len(previous_samples), np.newaxis]
+        crossfade[:len(samples)] += samples * fade_in[:len(samples), np.newaxis]
+
+        return crossfade
+
+    def play_stream(self, start_ms: int = 0) -> PlaybackState:
+        """
+        Starts playing the segment from `start_ms` on in the background and returns the state to follow and control playback.
+        """
+        sink = self.sink
+
+        segment = self._to_frame_source(self._segment)
+        frame_rate = segment.frame_rate
+        start_position = ms_to_frames(start_ms, frame_rate)
+        playback_state = PlaybackState(frame_rate, segment.channels, start_position)
+        stats = playback_state.stats
+
+        lead_frames = LEAD_TIME * frame_rate // 1000
+        ring_buffer = RingBuffer(2 * lead_frames, segment.channels, start_position)
+        # Frames the sink may be reading while a swap rewinds the buffer
+        guard_frames = 2 * sink.frames_per_buffer
+        # The callback's output, preallocated so that the audio thread doesn't allocate frames
+        out = np.zeros((sink.frames_per_buffer, segment.channels), dtype=np.float32)
+        end_position = segment.frame_count()
+
+        crossfade_frames = ms_to_frames(self.swap_crossfade_duration, frame_rate)
+        progress = (np.arange(crossfade_frames) + .5) / max(1, crossfade_frames)
+        swap_fade_in, swap_fade_out = fade_in_gain(progress, "equal_power"), fade_out_gain(progress, "equal_power")
 
-            i = 0
-            left = right = 0
-            while right < len(segment): 
-                if playback_state.request_stop:
-                    break
+        # Position of the first frame of the latest swapped in segment and when it was swapped in, until the frame is output
+        pending_swap: Optional[Tuple[int, float]] = None
 
-                if playback_state.swap_segment: 
-                    segment = playback_state.swap_segment
+        def callback(frame_count: int, output_time: float):
+            nonlocal out, pending_swap
+            callback_start = time.perf_counter()
+
+            if frame_count > len(out):
+                out = np.zeros((frame_count, out.shape[1]), dtype=np.float32)
+
+            if ring_buffer.get_buffered_frames() < lead_frames // 2:
+                playback_state.changed.set()
+
+            # Sinks that are not bound to real time wait for the frames instead of playing silence
+            missing = min(frame_count, end_position - ring_buffer.read_position) - ring_buffer.get_buffered_frames()
+            if not sink.real_time and missing > 0 and not playback_state.request_stop:
+                return None, True
+
+            start_frame = ring_buffer.read_position
+            stats.fill_levels.record(1000 * ring_buffer.get_buffered_frames() / frame_rate)
+
+            available = ring_buffer.read_into(out[:frame_count])
+            playback_state.update_clock(start_frame, ring_buffer.read_position, output_time)
+
+            expected = min(frame_count, end_position - start_frame)
+            if available < expected:
+                stats.underruns += 1
+                stats.underrun_frames += expected - available
+
+            swap = pending_swap
+            if swap is not None and swap[0] < ring_buffer.read_position:
+                swap_output_time = output_time + max(0, swap[0] - start_frame) / frame_rate
+                stats.swap_latencies.record(1000 * (swap_output_time - swap[1]))
+                pending_swap = None
+
+            finished = playback_state.request_stop or ring_buffer.read_position >= end_position
+            stats.callback_durations.record(1000 * (time.perf_counter() - callback_start))
+
+            return out[:frame_count], not finished
+
+        def write(samples: np.ndarray, position: int):
+            written = ring_buffer.write(samples, position)
+            if written < len(samples):
+                stats.overruns += 1
+                stats.overrun_frames += len(samples) - written
+
+        def write_stats():
+            if self.stats_file is not None:
+                stats.write(self.stats_file)
+
+        def feed(segment):
+            nonlocal end_position, pending_swap
+
+            def fill():
+                position = ring_buffer.get_write_position()
+                n_frames = min(end_position, ring_buffer.read_position + lead_frames) - position
+                if n_frames > 0:
+                    write(segment.get_frames(position, position + n_frames), position)
+
+            fill()
+            stats_time = time.perf_counter()
+            sink.start(callback, frame_rate, segment.channels)
+            playback_state.state = "running"
+
+            while not playback_state.request_stop and sink.is_active():
+                if playback_state.swap_segment:
+                    swap_time = playback_state.swap_time or time.perf_counter()
+                    swap_segment = self._to_frame_source(playback_state.swap_segment)
                     playback_state.swap_segment = None
-                    
+
                     # Safe-guard against swapping in a shorter segment that the original segment
-                    if len(segment) < left:
+                    if swap_segment.frame_count() < ring_buffer.read_position:
                         break
 
-                left = i * chunk_length
-                right = (i + 1) * chunk_length
-                right = min(right, len(segment))
-                
-                if left == right:
-                    break
+                    # Starting at a buffer boundary, so that the crossfade starts with a buffer
+                    boundary = -(-(ring_buffer.read_position + guard_frames) // sink.frames_per_buffer) * sink.frames_per_buffer
+                    position = ring_buffer.rewind(boundary, guard_frames)
+                    crossfade = self.get_swap_crossfade(segment, swap_segment, position, swap_fade_in, swap_fade_out)
 
-                stream.write(segment[left:right].raw_data)
-                
-                playback_state.played_milliseconds += chunk_length
+                    segment, end_position = swap_segment, swap_segment.frame_count()
+                    write(crossfade[:max(0, end_position - position)], position)
+                    pending_swap = (position, swap_time)
 
-                i += 1
-            
-            playback_state.state = "finished"
+                fill()
+
+                if time.perf_counter() - stats_time > STATS_INTERVAL:
+                    write_stats()
+                    stats_time = time.perf_counter()
+
+                playback_state.changed.wait(LEAD_TIME / 4000)
+                playback_state.changed.clear()
 
-        playback_state = PlaybackState(self._segment.frame_rate)
+            sink.close()
+
+            stats.log_stats()
+            write_stats()
+
+            playback_state.state = "finished"
 
         executor = ThreadPoolExecutor(1)
-        playback_future = executor.submit(playback_stream, self._segment, playback_state)
+        playback_future = executor.submit(feed, segment)
 
         playback_state.playback_future = playback_future
 
@@ -81,9 +255,9 @@ class Player():
 class CLI():
     
     @staticmethod
-    def play(path_to_mp3: str):
+    def play(path_to_mp3: str, sink: str = "pyaudio", wav_file: str = None):
             
-        player = Player(AudioSegment.from_mp3(path_to_mp3))
+        player = Player(AudioSegment.from_mp3(path_to_mp3), sink=create_sink(sink, wav_file))
         _playback_state = player.play_stream()
 
         while not _playback_state.playback_future.done():
@@ -91,5 +265,5 @@ class CLI():
             time.sleep(0.1)
 
 if __name__ == "__main__":
-    # python -m soundsride.player play $PATH_TO_MP3
+    # python -m soundsride.player play $PATH_TO_MP3 [--sink wav --wav_file $PATH_TO_WAV]
     fire.Fire(CLI.play)
@@ -0,0 +1,109 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+
+class RenderWorker:
+    """
+    Runs the scheduling and rendering of mix plans on a dedicated thread, so that request handlers only enqueue updates.
+
+    `front` is the segment last handed to the player. As soon as `render` returns a new segment,
+    it is published through `publish` and replaces `front`.
+    Jobs for which `render` returns None (e. g. because no rescheduling is required) publish nothing.
+
+    Pending jobs are kept in a single-slot mailbox: a job submitted while another one is still pending replaces it, 
+    so that after each render only the most recent update is processed instead of working through a stale backlog.
+    """
+
+    _STOP = object()
+
+    def __init__(self, render: Callable[..., Optional[Any]], publish: Callable[[Any], None], name: str = "render-worker") -> None:
+        self._render = render
+        self._publish = publish
+
+        self.front: Any = None
+        self._swap_lock = threading.Lock()
+
+        self.processed = 0
+        self.coalesced = 0
+
+        self._pending: Any = None
+        self._busy = False
+        self._condition = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, *args, **kwargs):
+        """
+        Puts a render job into the mailbox and returns immediately. `render` will be called with the given arguments, 
+        unless another job is submitted before the worker gets to it.
+        """
+        self._put((args, kwargs))
+
+    def _put(self, job: Any):
+        with self._condition:
+            if self._pending is not None and self._pending is not self._STOP:
+                self.coalesced += 1
+                logging.getLogger(__name__).debug("Coalescing pending render job, %s coalesced so far", self.coalesced)
+
+            if self._pending is not self._STOP:
+                self._pending = job
+
+            self._condition.notify_all()
+
+    def _take(self) -> Any:
+        with self._condition:
+            while self._pending is None:
+                self._condition.wait()
+
+            job, self._pending = self._pending, None
+            self._busy = True
+
+            return job
+
+    def _run(self):
+        while True:
+            job = self._take()
+
+            try:
+                if job is self._STOP:
+                    return
+
+                args, kwargs = job
+                segment = self._render(*args, **kwargs)
+                self.processed += 1
+
+                if segment is not None:
+                    self.swap(segment)
+            except Exception: # pylint: disable=broad-except
+                # A failing render must not take down the worker, the player keeps playing the front segment
+                logging.getLogger(__name__).exception("Render job failed")
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._condition:
+            return dict(processed=self.processed, coalesced=self.coalesced)
+
+    def swap(self, segment: Any):
+        """
+        Publishes `segment` and makes it the front segment. While `publish` runs, `front` is still the segment it replaces.
+        """
+        with self._swap_lock:
+            self._publish(segment)
+            self.front = segment
+
+    def join(self):
+        """
+        Blocks until the mailbox is empty and the current job is processed.
+        """
+        with self._condition:
+            while self._pending is not None or self._busy:
+                self._condition.wait()
+
+    def stop(self):
+        self._put(self._STOP)
+        self._thread.join()
@@ -0,0 +1,80 @@
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Preallocated float32 frames passed from a single producer thread to a single consumer, the audio callback.
+
+    Frames are addressed by their absolute position within the stream, which maps to the slot `position % capacity`.
+    The read position is only advanced by the consumer and the write position only moved by the producer,
+    so neither side takes a lock and the consumer never waits on the producer.
+    """
+
+    def __init__(self, capacity: int, channels: int, position: int = 0) -> None:
+        self.capacity = capacity
+        self.buffer = np.zeros((capacity, channels), dtype=np.float32)
+
+        # Frames before the read position were consumed, frames between read and write position are ready to be consumed.
+        # Streams starting at `position` are consumed from there on
+        self.read_position = position
+        self.write_position = position
+
+    def get_write_position(self) -> int:
+        """
+        Returns the position of the next frame the producer should write.
+        If the consumer has overtaken the producer, frames it skipped are not written anymore.
+        """
+        return max(self.write_position, self.read_position)
+
+    def get_buffered_frames(self) -> int:
+        return max(0, self.write_position - self.read_position)
+
+    def write(self, samples: np.ndarray, position: int) -> int:
+        """
+        Writes `samples` of the frames from `position` on, clipped to full scale, as far as they fit.
+        Returns the number of frames taken from `samples`, including those the consumer already skipped.
+        """
+        read_position = self.read_position
+
+        skipped = max(0, read_position - position)
+        position += skipped
+        n_frames = max(0, min(len(samples) - skipped, read_position + self.capacity - position))
+
+        slot = position % self.capacity
+        first_part = min(n_frames, self.capacity - slot)
+        np.clip(samples[skipped:skipped + first_part], -1, 1, out=self.buffer[slot:slot + first_part])
+        np.clip(samples[skipped + first_part:skipped + n_frames], -1, 1, out=self.buffer[:n_frames - first_part])
+
+        # Publishing the frames only after they were copied
+        self.write_position = position + n_frames
+
+        return skipped + n_frames
+
+    def rewind(self, position: int, guard_frames: int) -> int:
+        """
+        Discards the written frames from `position` on, so that the producer writes them again, e. g. from another segment.
+        The `guard_frames` after the read position are kept, as the consumer may be reading them right now.
+        Returns the position the producer continues writing at.
+        """
+        self.write_position = min(self.write_position, max(position, self.read_position + guard_frames))
+        return self.write_position
+
+    def read_into(self, out: np.ndarray) -> int:
+        """
+        Copies the next `len(out)` frames into `out`, filling frames that were not written in time with silence.
+        The read position advances by `len(out)` regardless, as playback time passes during an underrun as well.
+        Returns the number of frames that were available.
+        """
+        read_position = self.read_position
+        n_frames = len(out)
+        available = max(0, min(n_frames, self.write_position - read_position))
+
+        slot = read_position % self.capacity
+        first_part = min(available, self.capacity - slot)
+        out[:first_part] = self.buffer[slot:slot + first_part]
+        out[first_part:available] = self.buffer[:available - first_part]
+        out[available:] = 0
+
+        self.read_position = read_position + n_frames
+
+        return available
@@ -18,6 +18,7 @@ import fire
 
 
 from ..session import SoundsRideSession
+from ..library import get_library_manager
 from ..vehicle.gps_client import MibInterface
 
 from .soundsride_service_pb2 import (
@@ -54,11 +55,12 @@ class RpcHandlingException(Exception):
 
 class SoundsRideServicer(soundsride_service_pb2_grpc.SoundsRideServicer):
 
-    def __init__(self, mib_host, app_model=None) -> None:
+    def __init__(self, mib_host, app_model=None, sink: str = "pyaudio") -> None:
         super().__init__()
         self.sessions: Dict[int, SoundsRideSession] = dict()
         self.app_model = app_model
         self.mib_host = mib_host
+        self.sink = sink
         self.log = True
 
 
@@ -85,7 +87,8 @@ class SoundsRideServicer(soundsride_service_pb2_grpc.SoundsRideServicer):
             new_session_id = len(self.sessions)
 
             session_log_id = int(time.time() * 1000)
-            self.sessions[new_session_id] = SoundsRideSession(self.app_model, session_log_id=session_log_id)
+            self.sessions[new_session_id] = SoundsRideSession(
+                self.app_model, session_log_id=session_log_id, sink=self.sink, log_playback_stats=self.log)
 
             if self.log:
                 Path(f"log/{session_log_id}").mkdir(parents=True, exist_ok=True)
@@ -166,8 +169,8 @@ class SoundsRideServicer(soundsride_service_pb2_grpc.SoundsRideServicer):
 
 class GrpcServer:
 
-    def __init__(self, mib_host: str, app_model=None) -> None:
-        self.server = self._create_server(mib_host, app_model=app_model)
+    def __init__(self, mib_host: str, app_model=None, sink: str = "pyaudio") -> None:
+        self.server = self._create_server(mib_host, app_model=app_model, sink=sink)
 
     def get_server_credentials(self): 
         # https://www.sandtable.com/using-ssl-with-grpc-in-python/
@@ -193,7 +196,7 @@ class GrpcServer:
 
 
     @staticmethod
-    def _create_server(mib_host, port: int = 8888, app_model=None) -> grpc.Server:    
+    def _create_server(mib_host, port: int = 8888, app_model=None, sink: str = "pyaudio") -> grpc.Server:    
         server = grpc.server(
             ThreadPoolExecutor(max_workers=10),
             options=[
@@ -203,7 +206,7 @@ class GrpcServer:
             ])
 
         soundsride_service_pb2_grpc.add_SoundsRideServicer_to_server(
-            SoundsRideServicer(mib_host, app_model=app_model),
+            SoundsRideServicer(mib_host, app_model=app_model, sink=sink),
             server
         )
         
@@ -223,8 +226,21 @@ class GrpcServer:
         self.server.start()
 
 
-def run(mib_host: str):
-    grpc_server = GrpcServer(mib_host)
+def run(mib_host: str, preload_songs: bool = True, reload_library: bool = True, sink: str = "pyaudio"):
+    """
+    Serves sessions playing to `sink`, one of `sinks.SINKS`, e. g. "null" to run without a sound card.
+    """
+    library_manager = get_library_manager()
+
+    if preload_songs:
+        # Decoding all songs up front in parallel, so that no session has to wait for a song on first use
+        library_manager.snapshot.preload()
+
+    if reload_library:
+        # Songs added to or changed in the library are picked up by sessions started afterwards
+        library_manager.start()
+
+    grpc_server = GrpcServer(mib_host, sink=sink)
     grpc_server.start_blocking()
 
 
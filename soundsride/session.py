@@ -1,3 +1,5 @@
+import copy
+from itertools import count
 import shutil
 from concurrent.futures import ThreadPoolExecutor, thread
 import logging
@@ -5,19 +7,28 @@ from pathlib import Path
 from soundsride.service.soundsride_service_pb2 import UpdateTransitionSpecRequest
 import time
 from numpy import absolute, select
+import numpy as np
 import threading
 import traceback
+from typing import Any, Callable, Dict, List, Optional
 
 from pydub.audio_segment import AudioSegment
 import cv2
 
-from .song import SongDatabase, SongSnippet
+from .library import get_song_database
+from .song import SongSnippet
 from .mix_plan import TransitionSpec, MixPlan, MixPlanViz
+from .mixer import WindowedMixSegment
+from .render_worker import RenderWorker
+from .sinks import create_sink
 
 from .canvas.transition_spec_canvas import TransitionCanvas 
 from .viz_player import VizPlayer
 from .consolidator import SerialConsolidator, UpdatingStrategyDetection
 
+# Frames of the mix per point of the waveform plot
+WAVEFORM_STEP_FRAMES = 100
+
 def get_millis() -> int:
     return int(time.time() * 1000)
 
@@ -34,23 +45,39 @@ class AppModel:
 
 class SoundsRideSession:
     
-    def __init__(self, app_model: AppModel, session_log_id: str = None) -> None:
+    def __init__(self, app_model: AppModel, session_log_id: str = None, sink: str = "pyaudio", log_playback_stats: bool = False) -> None:
         self.app_model = app_model
         self.session_origin = None
         self.session_log_id = session_log_id
         self.transition_spec_canvas = TransitionCanvas()
         self.transition_consolidator = SerialConsolidator(UpdatingStrategyDetection(1050, 15_000))
-        self.viz_player = VizPlayer()
+        # See `sinks.SINKS` for the sinks, the WAV sink records each playback of the session to its log directory.
+        # Playback restarts whenever a mix ended before the next one was rendered, so recordings are numbered to keep them all
+        playback_ids = count()
+        self.viz_player = VizPlayer(
+            sink_factory=lambda: create_sink(sink, Path(f"log/{session_log_id}/playback_{next(playback_ids)}.wav")),
+            stats_file=Path(f"log/{session_log_id}/playback_stats.json") if log_playback_stats else None)
         # self.viz_player.monitor_marker_async()
         self.latest_update = None
         
         self.last_mix_plan = None
 
+        # Only this many ms of the mix are rendered before handing it to the player, the rest is rendered during playback
+        self.render_lookahead = 10_000
+
         self.lock = threading.Lock()
 
-        self.song_database = SongDatabase()
+        # Scheduling and rendering happen off the request handler, the rendered segment is swapped into the player when ready
+        self.render_worker = RenderWorker(self._render_mix_plan, self._publish_segment)
+
+        # The library snapshot at session start, kept for the whole session even if the library is reloaded meanwhile
+        self.song_database = get_song_database()
+        # Transition id -> snippet selected for it
+        self.selected_snippets: Dict[Any, SongSnippet] = dict()
 
         self.viz_threadpool = ThreadPoolExecutor(3)
+        # Drawing of the latest rendered segment, which waits until the segment is playing
+        self._pending_viz: Optional[Callable[[], None]] = None
 
         
     def schedule_mix_plan(self, transition_spec: TransitionSpec, only_after_timestamp: int) -> MixPlan:
@@ -62,11 +89,15 @@ class SoundsRideSession:
             last_scheduled_snippet = self.last_mix_plan.get_last_scheduled_snippet_before_timestamp(only_after_timestamp)
 
             if last_scheduled_snippet:
-                mix_plan._scheduled_snippets.append(last_scheduled_snippet)
+                # Copying as setting the transitions would otherwise alter the last mix plan we diff against
+                mix_plan._scheduled_snippets.append(copy.copy(last_scheduled_snippet))
+
 
+        transitions = list(zip(transition_spec.transition_ids, transition_spec.iterate_transitions(absolute=True)))
+        previous_timestamp = only_after_timestamp
 
         i = 0
-        for transition_id, (left_genre, timestamp, right_genre) in zip(transition_spec.transition_ids, transition_spec.iterate_transitions(absolute=True)):
+        for transition_no, (transition_id, (left_genre, timestamp, right_genre)) in enumerate(transitions):
             logging.getLogger(__name__).debug("Scheduling: from %s at %s to %s", left_genre, timestamp, right_genre)
             # snippet = self.song_database.get_snippet_by_transition_id(int(transition_id))
             
@@ -78,7 +109,14 @@ class SoundsRideSession:
 
             i += 1
 
-            snippet = self.song_database.get_snippet_by_transition_type(right_genre)
+            next_timestamp = transitions[transition_no + 1][1][1] if transition_no + 1 < len(transitions) else None
+            snippet = self._select_snippet(
+                transition_id, 
+                right_genre, 
+                timestamp - previous_timestamp, 
+                next_timestamp - timestamp if next_timestamp is not None else None,
+                [scheduled_snippet.song_snippet for scheduled_snippet in mix_plan.scheduled_snippets])
+            previous_timestamp = timestamp
 
             if right_genre == "highwayExit":
                 transition_mode = "SLOW"
@@ -94,86 +132,142 @@ class SoundsRideSession:
 
         return mix_plan  
 
-    def update_mix_plan(self, request: UpdateTransitionSpecRequest, request_log_id: str):
-        if self.lock.locked():
-            logging.getLogger(__name__).warning("DROPPED FRAME!")
-            return 
-
-        # Currently, we drop frames all the time
-        # Must speed up this by a factor of 10
-        # - Render off-thread
-        # - Only export audio for the next 10 seconds now or pull audio and pre-fetch off-thread
+    def _select_snippet(self, transition_id, transition_type: str, pre_transition_gap: int, post_transition_gap: int, 
+            recent_snippets: List[SongSnippet]) -> SongSnippet:
+        """
+        Selects the snippet for a transition by how well it fits the gaps around it, avoiding the snippets scheduled before.
+        Once selected, a transition keeps its snippet while it remains a candidate, 
+        so that drifting transition time estimates don't swap snippets back and forth.
+        """
+        candidates = self.song_database.get_candidates_by_transition_type(transition_type)
 
-        with self.lock:     
+        snippet = self.selected_snippets.get(transition_id)
+        if snippet is None or snippet not in candidates:
+            snippet = candidates.select(pre_transition_gap, post_transition_gap, recent_snippets)
+            self.selected_snippets[transition_id] = snippet
 
-            next_transistion_spec = TransitionSpec.from_spec_protobuf(request, absolute_start_timestamp=None, negative_ett_handling="skip")
-            print("next_transistion_spec", next_transistion_spec)
+        return snippet
 
-            if not next_transistion_spec.genre_transitions:
-                return
-            
-            # First time playback 
+    def update_mix_plan(self, request: UpdateTransitionSpecRequest, request_log_id: str):
+        """
+        Hands the request over to the render worker and returns right away, 
+        so that handling a request does not depend on how long the rendering takes.
+        Requests arriving during a render replace each other, only the latest one is rendered next.
+        """
+        next_transistion_spec = TransitionSpec.from_spec_protobuf(request, absolute_start_timestamp=None, negative_ett_handling="skip")
+        print("next_transistion_spec", next_transistion_spec)
+
+        if not next_transistion_spec.genre_transitions:
+            return
+
+        with self.lock:
+            # The session clock starts with the first request, playback starts from the session time once the first mix is rendered
             if not self.session_origin:
-                # We must set the session_origin only at the same time (or just shortly before) first playback,
-                # otherwise playback_time and session_time are shifted
                 self.session_origin = get_millis()
 
-            now_in_ms = get_millis() - self.session_origin
+        # The request's time is taken on arrival, as the estimated times to transition are relative to it
+        now_in_ms = self.get_session_time()
 
-            next_transistion_spec.absolute_start_timestamp = now_in_ms
+        next_transistion_spec.absolute_start_timestamp = now_in_ms
 
-            updating_strategy = self.transition_consolidator.update(now_in_ms, next_transistion_spec)
-            logging.getLogger(__name__).info("Strategy is %s", (updating_strategy and updating_strategy.name) or None)
+        self.render_worker.submit(next_transistion_spec, now_in_ms, request_log_id)
 
-            self.transition_consolidator.print_to_console()
-            consolidated_transition_spec = self.transition_consolidator.get()
+    def get_session_time(self) -> int:
+        """
+        Returns the ms since the session origin, which is the position in the mix being played while playback is running.
+        The session keeps this single clock, so that the consolidator's timestamps don't jump between unrelated clocks.
+        """
+        return get_millis() - self.session_origin
 
+    def _publish_segment(self, segment: WindowedMixSegment):
+        replaced_segment = self.render_worker.front
+        playback_state = self.viz_player.playback_state
 
-            if (updating_strategy and updating_strategy.action_required) or (updating_strategy is None):
-                
-                logging.getLogger(__name__).info("Scheduling mix_plan from transition_spec %s", next_transistion_spec)
-                mix_plan = self.schedule_mix_plan(consolidated_transition_spec, now_in_ms)
+        # Playback starts where the session is in the mix, the first time as well as after a mix ended
+        self.viz_player.swap_segment(segment, start_ms=self.get_session_time())
 
-                logging.getLogger(__name__).info("Setting snippets from transition_spec")
-                mix_plan.set_snippet_transitions(transition_type="crossfade")
+        if self.viz_player.playback_state is not playback_state:
+            # Re-anchoring the session clock on the playback clock, so that the time it took to start playback is not skipped
+            with self.lock:
+                self.session_origin = get_millis() - self.viz_player.playback_state.played_milliseconds
 
-                logging.getLogger(__name__).info("Rendering signal.")
-                segment = mix_plan.to_audio_segment() # TODO: ONLY LOAD NEXT CHUNK, QUEUE EVERYTHING ELSE
-                self.last_mix_plan = mix_plan
+        # Windows prefetched for the replaced segment would not be played anymore
+        if replaced_segment is not None:
+            replaced_segment.retire()
 
-                logging.getLogger(__name__).info("Updating signal.") 
-                self.viz_player.swap_segment(segment)
-              
+        pending_viz, self._pending_viz = self._pending_viz, None
+        if pending_viz is not None:
+            self.viz_threadpool.submit(pending_viz)
 
-            def viz():
+    def _render_mix_plan(self, next_transistion_spec: TransitionSpec, now_in_ms: int, request_log_id: str) -> Optional[WindowedMixSegment]:
+        """
+        Consolidates, schedules and renders on the render worker's thread. 
+        Returns the segment to publish, or None if the current one can keep playing.
+        """
+        updating_strategy = self.transition_consolidator.update(now_in_ms, next_transistion_spec)
+        logging.getLogger(__name__).info("Strategy is %s", (updating_strategy and updating_strategy.name) or None)
+
+        self.transition_consolidator.print_to_console()
+        consolidated_transition_spec = self.transition_consolidator.get()
+
+        segment = None
+
+        if (updating_strategy and updating_strategy.action_required) or (updating_strategy is None):
+            
+            logging.getLogger(__name__).info("Scheduling mix_plan from transition_spec %s", next_transistion_spec)
+            mix_plan = self.schedule_mix_plan(consolidated_transition_spec, now_in_ms)
+
+            logging.getLogger(__name__).info("Setting snippets from transition_spec")
+            mix_plan.set_snippet_transitions(transition_type="crossfade")
+
+            logging.getLogger(__name__).info("Rendering signal.")
+            # The new segment reuses what was rendered for the front segment wherever the mix plans agree
+            segment = WindowedMixSegment(mix_plan, window_length=self.render_lookahead, previous=self.render_worker.front)
+            segment.prefetch(now_in_ms)
+            mix_plan.snippet_render_cache.log_stats()
+            logging.getLogger(__name__).info("Render worker updates: %s", self.render_worker.get_stats())
+            self.last_mix_plan = mix_plan
+
+        def viz():
+            try:
                 if updating_strategy and updating_strategy.action_required:
-                    self.transition_spec_canvas.draw_segment(segment)
+                    # Plotting needs far fewer points than rendering the whole mix, whose windows are left for the player to render
+                    waveform = segment.mix_plan.render_decimated(WAVEFORM_STEP_FRAMES)
+                    waveform_np_int = (np.clip(waveform[:, 0], -1, 1) * 32767).astype(np.int16)
+                    self.transition_spec_canvas.draw_waveform(waveform_np_int, segment.frame_rate / WAVEFORM_STEP_FRAMES)
                     # self.transition_spec_canvas.draw_snippets(mix_plan.scheduled_snippets)
-                    
-                try:
-                    logging.getLogger(__name__).info("Setting consolidated spec...")
-                    self.transition_spec_canvas.set_consolidated_transition_spec(consolidated_transition_spec, updating_strategy)
 
-                    logging.getLogger(__name__).info("Drawing transition specs...")
-                    self.transition_spec_canvas.draw_transition_spec(next_transistion_spec)
+                logging.getLogger(__name__).info("Setting consolidated spec...")
+                self.transition_spec_canvas.set_consolidated_transition_spec(consolidated_transition_spec, updating_strategy)
 
-                    logging.getLogger(__name__).info("Setting marker...")
-                    self.transition_spec_canvas.set_marker(now_in_ms)
+                logging.getLogger(__name__).info("Drawing transition specs...")
+                self.transition_spec_canvas.draw_transition_spec(next_transistion_spec)
 
+                logging.getLogger(__name__).info("Setting marker...")
+                self.transition_spec_canvas.set_marker(now_in_ms)
+
+                # Nothing may have been played yet if no segment was rendered so far
+                if self.viz_player.playback_state is not None:
                     logging.getLogger(__name__).info("Setting waveform marker...")
                     self.transition_spec_canvas.set_waveform_marker(self.viz_player.playback_state.played_milliseconds)
-                                    
-                    logging.getLogger(__name__).info("Saving to waveform marker...")
-                    self.transition_spec_canvas.save("canvas.jpg")
+                                
+                logging.getLogger(__name__).info("Saving to waveform marker...")
+                self.transition_spec_canvas.save("canvas.jpg")
 
-                    if request_log_id:
-                        shutil.copyfile("canvas.jpg", f"log/{self.session_log_id}/{request_log_id}.jpg")
-            
-                except Exception as e:
-                    print(traceback.format_exc())
+                if request_log_id:
+                    shutil.copyfile("canvas.jpg", f"log/{self.session_log_id}/{request_log_id}.jpg")
+        
+            except Exception as e:
+                print(traceback.format_exc())
 
+        if segment is None:
             self.viz_threadpool.submit(viz)
+        else:
+            # Drawn once the render worker published the segment, so that the marker shows the position in the new playback
+            self._pending_viz = viz
+
+        logging.getLogger(__name__).info("Drawing finished!")
 
-            logging.getLogger(__name__).info("Drawing finished!")
+        logging.getLogger(__name__).info("Done.")
 
-            logging.getLogger(__name__).info("Done.") 
\ No newline at end of file
+        return segment
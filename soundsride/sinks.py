@@ -0,0 +1,208 @@
+"""
+Outputs the `Player` can play to.
+
+Sinks pull buffers of frames from the player's callback the way an audio device does,
+so that playback works the same with a sound card, on a headless machine or when recording a ride to a file.
+"""
+
+from pathlib import Path
+import threading
+import time
+from typing import Callable, Optional, Tuple
+import wave
+
+import numpy as np
+
+from .mixer import CANONICAL_SAMPLE_WIDTH, array_to_segment
+
+# Frames per buffer, which bounds the latency of swaps and stops
+DEVICE_BUFFER_FRAMES = 256
+
+# Called with the number of frames and the `time.perf_counter` time the first of them is output.
+# Returns the frames, or None if they are not ready yet, and whether to continue
+SinkCallback = Callable[[int, float], Tuple[Optional[np.ndarray], bool]]
+
+
+class AudioSink:
+    """
+    Pulls buffers of `frames_per_buffer` float32 frames from a callback once started, until the callback asks to stop.
+    """
+
+    # Real-time sinks don't wait for frames that are late, the player fills them with silence instead
+    real_time = True
+
+    def __init__(self, frames_per_buffer: int = DEVICE_BUFFER_FRAMES) -> None:
+        self.frames_per_buffer = frames_per_buffer
+
+    def start(self, callback: SinkCallback, frame_rate: int, channels: int):
+        raise NotImplementedError()
+
+    def is_active(self) -> bool:
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+
+class PyAudioSink(AudioSink):
+    """
+    Plays to the default output device in PyAudio's callback mode.
+    """
+
+    def __init__(self, frames_per_buffer: int = DEVICE_BUFFER_FRAMES) -> None:
+        super().__init__(frames_per_buffer)
+        self._pyaudio = None
+        self._stream = None
+
+    def start(self, callback: SinkCallback, frame_rate: int, channels: int):
+        # Imported here, so that the other sinks work on machines without PyAudio or a sound card
+        from pyaudio import PyAudio, paComplete, paContinue, paFloat32 # pylint: disable=import-outside-toplevel
+
+        output_latency = 0.
+
+        def stream_callback(_in_data, frame_count, time_info, _status):
+            # Some host APIs don't report the output time, the stream's nominal latency is the fallback then
+            dac_time = time_info["output_buffer_dac_time"]
+            dac_delay = dac_time - time_info["current_time"] if dac_time else output_latency
+
+            frames, more = callback(frame_count, time.perf_counter() + dac_delay)
+            # PyAudio copies from any contiguous array exposing its buffer, so the player's preallocated frames are handed over as they are.
+            # Memoryviews and bytearrays are rejected by PyAudio's argument parsing, and `tobytes` would allocate per callback
+            return frames, paContinue if more else paComplete
+
+        self._pyaudio = PyAudio()
+        self._stream = self._pyaudio.open(
+            format=paFloat32, channels=channels, rate=frame_rate, output=True,
+            frames_per_buffer=self.frames_per_buffer, stream_callback=stream_callback, start=False)
+
+        output_latency = self._stream.get_output_latency()
+        self._stream.start_stream()
+
+    def is_active(self) -> bool:
+        return self._stream is not None and self._stream.is_active()
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._pyaudio.terminate()
+            self._stream = None
+
+
+class NullSink(AudioSink):
+    """
+    Discards the frames, pulling them at the pace a device would, from a thread of its own.
+    With `real_time` disabled, frames are pulled as fast as the player provides them instead.
+    """
+
+    def __init__(self, frames_per_buffer: int = DEVICE_BUFFER_FRAMES, real_time: bool = True) -> None:
+        super().__init__(frames_per_buffer)
+        self.real_time = real_time
+        self._stop = threading.Event()
+        self._active = False
+        self._thread: threading.Thread = None
+
+    def start(self, callback: SinkCallback, frame_rate: int, channels: int):
+        self._active = True
+        self._thread = threading.Thread(target=self._run, args=(callback, frame_rate, channels), name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def _run(self, callback: SinkCallback, frame_rate: int, channels: int):
+        try:
+            self.open(frame_rate, channels)
+            start_time = time.perf_counter()
+            output_frames = 0
+
+            while not self._stop.is_set():
+                if self.real_time:
+                    # Each buffer is pulled when the one before would have been played out
+                    output_time = start_time + output_frames / frame_rate
+                    self._stop.wait(max(0., output_time - time.perf_counter()))
+                else:
+                    output_time = time.perf_counter()
+
+                frames, more = callback(self.frames_per_buffer, output_time)
+                if frames is None:
+                    self._stop.wait(.001)
+                    continue
+
+                self.write(frames)
+                output_frames += len(frames)
+
+                if not more:
+                    break
+        finally:
+            self._active = False
+            self.finish()
+
+    def open(self, frame_rate: int, channels: int):
+        pass
+
+    def write(self, frames: np.ndarray):
+        pass
+
+    def finish(self):
+        pass
+
+    def is_active(self) -> bool:
+        return self._active
+
+    def close(self):
+        self._stop.set()
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+class FreeRunningSink(NullSink):
+    """
+    Discards the frames as fast as the player provides them, e. g. to benchmark rendering.
+    """
+
+    def __init__(self, frames_per_buffer: int = DEVICE_BUFFER_FRAMES) -> None:
+        super().__init__(frames_per_buffer, real_time=False)
+
+
+class WavSink(NullSink):
+    """
+    Writes the frames to `wav_file` as they are played, so that a ride can be listened to afterwards exactly as it was played.
+    """
+
+    def __init__(self, wav_file: Path, frames_per_buffer: int = DEVICE_BUFFER_FRAMES, real_time: bool = True,
+            sample_width: int = CANONICAL_SAMPLE_WIDTH) -> None:
+        super().__init__(frames_per_buffer, real_time)
+        self.wav_file = Path(wav_file)
+        self.sample_width = sample_width
+        self._wave: wave.Wave_write = None
+
+    def open(self, frame_rate: int, channels: int):
+        self._wave = wave.open(str(self.wav_file), "wb") # pylint: disable=consider-using-with
+        self._wave.setnchannels(channels)
+        self._wave.setsampwidth(self.sample_width)
+        self._wave.setframerate(frame_rate)
+
+    def write(self, frames: np.ndarray):
+        self._wave.writeframes(array_to_segment(frames, self._wave.getframerate(), self.sample_width).raw_data)
+
+    def finish(self):
+        if self._wave is not None:
+            self._wave.close()
+            self._wave = None
+
+
+SINKS = {
+    "pyaudio": PyAudioSink,
+    "null": NullSink,
+    "free_running": FreeRunningSink,
+    "wav": WavSink,
+}
+
+
+def create_sink(name: str, wav_file: Path = None) -> AudioSink:
+    """
+    Returns the sink called `name` in `SINKS`, the WAV sink writing to `wav_file`.
+    """
+    if name == "wav":
+        return WavSink(wav_file)
+
+    return SINKS[name]()
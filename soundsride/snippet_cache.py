@@ -0,0 +1,81 @@
+from collections import OrderedDict
+import logging
+import threading
+from typing import Hashable, Optional
+
+import numpy as np
+
+
+class SnippetRenderCache:
+    """
+    Bounded LRU cache for rendered (that is sliced, converted and faded) snippet buffers.
+
+    Most mix plan updates only move a single transition, so most scheduled snippets keep their fade geometry
+    and their rendered buffers can be reused instead of being sliced and faded again.
+    The cache evicts least recently used buffers as soon as the total size exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024) -> None:
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Keys identify songs by `PcmBuffer.identity`, so that entries don't keep songs alive beyond what `max_bytes` accounts for
+        self._entries: "OrderedDict[Hashable, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            samples = self._entries.get(key)
+
+            if samples is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            return samples
+
+    def put(self, key: Hashable, samples: np.ndarray) -> np.ndarray:
+        samples.flags.writeable = False
+
+        if samples.nbytes > self.max_bytes:
+            return samples
+
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+
+            self._entries[key] = samples
+            self.current_bytes += samples.nbytes
+
+            while self.current_bytes > self.max_bytes:
+                _, evicted_samples = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_samples.nbytes
+                self.evictions += 1
+
+        return samples
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def get_hit_rate(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.
+
+    def log_stats(self):
+        logging.getLogger(__name__).info(
+            "Snippet render cache: %s hits, %s misses (hit rate %.2f), %s evictions, %s entries with %.1f MB",
+            self.hits, self.misses, self.get_hit_rate(), self.evictions, len(self._entries), self.current_bytes / 1024 / 1024)
+
+
+snippet_render_cache = SnippetRenderCache()
@@ -0,0 +1,77 @@
+from bisect import bisect_left
+from typing import Collection, List, Optional, TYPE_CHECKING
+
+from .loudness import TARGET_LOUDNESS
+
+if TYPE_CHECKING:
+    from .song import SongSnippet
+
+
+class SnippetCandidates:
+    """
+    The candidate snippets of a transition type, indexed by their pre-transition and by their post-transition duration.
+
+    The snippets best fitting the gap before a transition are found by binary search on the pre-transition durations,
+    those whose post-transition part just covers the gap after the transition by binary search on the post-transition durations.
+    Only the few candidates around these positions are scored, taking into account both fits, the loudness and recent repeats,
+    so that selection takes microseconds regardless of the size of the library.
+    """
+
+    # Candidates on each side of the best fits that are scored
+    NEIGHBOURHOOD = 3
+
+    # Penalties in ms of pre-transition misfit
+    MISSING_POST_TRANSITION_PENALTY = 1.
+    LOUDNESS_PENALTY = 100.
+    REPEAT_PENALTY = 60_000.
+
+    def __init__(self, snippets: List["SongSnippet"], default: "SongSnippet" = None) -> None:
+        self.snippets = sorted(snippets, key=lambda snippet: snippet.get_pre_transition_duration())
+        self.pre_transition_durations = [snippet.get_pre_transition_duration() for snippet in self.snippets]
+
+        self.snippets_by_post_transition_duration = sorted(snippets, key=lambda snippet: snippet.get_post_transition_duration())
+        self.post_transition_durations = [snippet.get_post_transition_duration() for snippet in self.snippets_by_post_transition_duration]
+        self.default = default or self.snippets[-1]
+
+    def __len__(self) -> int:
+        return len(self.snippets)
+
+    def __contains__(self, snippet: "SongSnippet") -> bool:
+        return any(candidate is snippet for candidate in self.snippets)
+
+    def _get_penalty(self, snippet: "SongSnippet", pre_transition_gap: int, post_transition_gap: Optional[int],
+            recent_snippets: Collection["SongSnippet"]) -> float:
+        penalty = float(abs(snippet.get_pre_transition_duration() - pre_transition_gap))
+
+        if post_transition_gap is not None:
+            penalty += self.MISSING_POST_TRANSITION_PENALTY * max(0, post_transition_gap - snippet.get_post_transition_duration())
+
+        if snippet.loudness is not None:
+            penalty += self.LOUDNESS_PENALTY * abs(snippet.loudness - TARGET_LOUDNESS)
+
+        if any(recent_snippet is snippet for recent_snippet in recent_snippets):
+            penalty += self.REPEAT_PENALTY
+
+        return penalty
+
+    def select(self, pre_transition_gap: int = None, post_transition_gap: int = None,
+            recent_snippets: Collection["SongSnippet"] = ()) -> "SongSnippet":
+        """
+        Returns the candidate whose pre-transition part best fits the `pre_transition_gap` ms before the transition,
+        preferring candidates whose post-transition part lasts `post_transition_gap` ms, which are close to the target loudness
+        and which are not among `recent_snippets`. Without a gap, the transition type's default snippet is returned.
+        """
+        if pre_transition_gap is None:
+            return self.default
+
+        position = bisect_left(self.pre_transition_durations, pre_transition_gap)
+        neighbourhood = self.snippets[max(0, position - self.NEIGHBOURHOOD):position + self.NEIGHBOURHOOD]
+
+        if post_transition_gap is not None:
+            # Snippets lasting longer after the transition than the gap fit equally well, so the shortest of them are the closest fits
+            position = bisect_left(self.post_transition_durations, post_transition_gap)
+            neighbourhood += self.snippets_by_post_transition_duration[max(0, position - self.NEIGHBOURHOOD):position + self.NEIGHBOURHOOD]
+
+        return min(
+            neighbourhood,
+            key=lambda snippet: self._get_penalty(snippet, pre_transition_gap, post_transition_gap, recent_snippets))
@@ -1,48 +1,114 @@
 import logging
 from os import isatty
 from pathlib import Path
-from typing import List, Dict
+import threading
+from typing import Any, Callable, Collection, List, Dict, Tuple, Union
 
 from pydub import AudioSegment
+import numpy as np
+
+from .mixer import PcmBuffer, frames_to_ms
+from . import pcm_cache
+from .catalog import CATALOG_FILE, read_catalog
+from .loudness import combine_block_loudness, get_normalization_gain, measure_loudness
+from .snippet_selection import SnippetCandidates
 
 class SongSnippet:
+    """
+    Bounds of a snippet within a song. 
+    The bounds are kept as frame indices into the song's PCM, the millisecond timestamps are derived from them.
+    """
+
     def __init__(self,
-                 base_audio_segment: AudioSegment,
+                 base_pcm: Union[PcmBuffer, AudioSegment],
                  snippet_id: int,
                  pre_transition_genre: str,
                  post_transition_genre: str,
                  snippet_start_timestamp: int,
                  genre_transition_timestamp: int,
-                 snippet_end_timestamp: int) -> None:
-
-        self.base_audio_segment = base_audio_segment
+                 snippet_end_timestamp: int,
+                 downbeats: np.ndarray = None,
+                 loudness: float = None) -> None:
+        """
+        `downbeats` are the song's downbeats in ms, sorted, if the song was analyzed (see `beats`).
+        `loudness` is the snippet's RMS level in dBFS, snippets without are not normalized.
+        """
+
+        if isinstance(base_pcm, AudioSegment):
+            base_pcm = PcmBuffer.from_audio_segment(base_pcm)
+
+        self.base_pcm = base_pcm
         self.snippet_id = snippet_id
         self.pre_transition_genre = pre_transition_genre
         self.post_transition_genre = post_transition_genre
         
-        self.snippet_start_timestamp = snippet_start_timestamp 
+        self.snippet_start_frame = base_pcm.ms_to_frames(snippet_start_timestamp)
         # set to 0 to avoid silences
 
-        self.genre_transition_timestamp = genre_transition_timestamp
+        self.genre_transition_frame = base_pcm.ms_to_frames(genre_transition_timestamp)
         
-        self.snippet_end_timestamp = snippet_end_timestamp
-        # set to len(base_audio_segment) to avoid silences
+        self.snippet_end_frame = base_pcm.ms_to_frames(snippet_end_timestamp)
+        # set to len(base_pcm) to avoid silences
+
+        self.downbeats = downbeats
+        self.loudness = loudness
+
+    @property
+    def frame_rate(self) -> int:
+        return self.base_pcm.frame_rate
+
+    @property
+    def snippet_start_timestamp(self) -> int:
+        return frames_to_ms(self.snippet_start_frame, self.frame_rate)
+
+    @property
+    def genre_transition_timestamp(self) -> int:
+        return frames_to_ms(self.genre_transition_frame, self.frame_rate)
+
+    @property
+    def snippet_end_timestamp(self) -> int:
+        return frames_to_ms(self.snippet_end_frame, self.frame_rate)
 
     def get_length(self) -> int:
-        return self.snippet_end_timestamp - self.snippet_start_timestamp
+        return frames_to_ms(self.get_length_frames(), self.frame_rate)
 
     def get_pre_transition_duration(self):
-        return self.genre_transition_timestamp - self.snippet_start_timestamp
+        return frames_to_ms(self.get_pre_transition_frames(), self.frame_rate)
 
     def get_post_transition_duration(self):
-        return self.snippet_end_timestamp - self.genre_transition_timestamp
+        return frames_to_ms(self.get_post_transition_frames(), self.frame_rate)
+
+    def get_length_frames(self) -> int:
+        return self.snippet_end_frame - self.snippet_start_frame
+
+    def get_pre_transition_frames(self) -> int:
+        return self.genre_transition_frame - self.snippet_start_frame
+
+    def get_post_transition_frames(self) -> int:
+        return self.snippet_end_frame - self.genre_transition_frame
+
+    def get_normalization_gain(self) -> float:
+        """
+        Returns the linear gain bringing the snippet to the target loudness.
+        """
+        return get_normalization_gain(self.loudness)
+
+    @property
+    def base_audio_segment(self) -> AudioSegment:
+        return self.base_pcm.to_audio_segment()
+
+    def get_samples(self) -> np.ndarray:
+        """
+        Returns a view of the snippet's samples in the base PCM.
+        """
+        return self.base_pcm.samples[self.snippet_start_frame:self.snippet_end_frame]
 
     def get_audio_segment(self) -> AudioSegment:
-        return self.base_audio_segment[self.snippet_start_timestamp:self.snippet_end_timestamp]
+        return self.base_pcm.to_audio_segment(self.snippet_start_frame, self.snippet_end_frame)
 
 class Song:
     @staticmethod
-    def _parse_metadata_file(metadata_file: Path):
+    def _parse_metadata_file(metadata_file: Path) -> Dict[int, str]:
         print(metadata_file)
         metadata_text = metadata_file.read_text()
         phases = metadata_text.splitlines(keepends=False)
@@ -55,6 +121,10 @@ class Song:
 
             metadata_dict[phase_start_timestamp] = phase_mood
 
+        return metadata_dict
+
+    @staticmethod
+    def _get_transition_table(metadata_dict: Dict[int, str]) -> Dict[str, Dict[str, List[int]]]:
         transition_table: Dict[str, Dict[str, List[int]]] = dict()
 
         metadata_list = list(metadata_dict.items())
@@ -72,12 +142,70 @@ class Song:
 
             timestamps.append(transition_timestamp)
 
-        return metadata_dict, transition_table
+        return transition_table
+
+    def __init__(self, audio_file: Path, metadata_file: Union[Path, Dict[int, str]], 
+            content_hash: str = None, loudness: float = None, block_loudness: List[float] = None, downbeats: List[int] = None):
+        """
+        `metadata_file` is either a file of `<start timestamp in ms> <genre>` lines or the phases as dict from timestamp to genre.
+        `content_hash`, `loudness` and `block_loudness` (in dBFS, see `loudness`) and `downbeats` (in ms) 
+        are known if the song comes from the catalog.
+        """
+        self.audio_file = audio_file
+        self.content_hash = content_hash
+        self.loudness = loudness
+        self.block_loudness = block_loudness
+        # Sorted, so that the downbeat closest to a cut is found by binary search when scheduling
+        self.downbeats = np.sort(np.asarray(downbeats, dtype=np.int64)) if downbeats else None
+
+        self._pcm: PcmBuffer = None
+        self._pcm_lock = threading.Lock()
+
+        if isinstance(metadata_file, dict):
+            self.metadata_dict = dict(metadata_file)
+        else:
+            self.metadata_dict = Song._parse_metadata_file(metadata_file)
+
+        self.transition_table = Song._get_transition_table(self.metadata_dict)
+
+        # Timestamps at which the phases start and, per pair of genres, the ids of the phases starting with such a transition
+        self.phase_boundaries: List[int] = sorted(self.metadata_dict.keys())
+        phase_ids = {timestamp: phase_id for phase_id, timestamp in enumerate(self.phase_boundaries)}
+
+        self._transition_phase_ids: Dict[Tuple[str, str], List[int]] = {
+            (pre_transition_genre, post_transition_genre): [phase_ids[timestamp] for timestamp in timestamps]
+            for pre_transition_genre, post_transitions in self.transition_table.items()
+            for post_transition_genre, timestamps in post_transitions.items()
+        }
 
-    def __init__(self, audio_file: Path, metadata_file: Path):
-        self.audio_segment = AudioSegment.from_mp3(str(audio_file))
-        self.metadata_dict, self.transition_table = Song._parse_metadata_file(
-            metadata_file)
+        self._snippet_index: Dict[Tuple[str, str], Tuple[SongSnippet, ...]] = None
+        self._snippet_index_lock = threading.Lock()
+
+    @property
+    def pcm(self) -> PcmBuffer:
+        """
+        The song's decoded float32 PCM, which all snippets of the song refer to. 
+        Decoding is deferred until first access, so that songs which are never played are never decoded,
+        and skipped altogether if the song is in the on-disk PCM cache.
+        """
+        if self._pcm is None:
+            with self._pcm_lock:
+                if self._pcm is None:
+                    self._pcm = pcm_cache.load_pcm(self.audio_file, content_hash=self.content_hash)
+
+        return self._pcm
+
+    def get_loudness(self, start: int, end: int) -> float:
+        """
+        Returns the RMS level in dBFS between `start` and `end` ms, from the catalog if available.
+        Otherwise it is measured, which happens once per snippet as snippets are built only once.
+        """
+        if self.block_loudness:
+            loudness = combine_block_loudness(self.block_loudness, start, end)
+            if loudness is not None:
+                return loudness
+
+        return measure_loudness(self.pcm.samples[self.pcm.ms_to_frames(start):self.pcm.ms_to_frames(end)])
 
     def get_number_of_phases(self):
         return len(self.metadata_dict)
@@ -88,77 +216,162 @@ class Song:
     def get_number_of_genre_transitions(self):
         return self.get_number_of_snippets()
 
-    def get_full_snippets_by_genres(self, pre_transition_genre: str, post_transition_genre: str) -> SongSnippet:
-        transition_timestamps = self.transition_table[pre_transition_genre][post_transition_genre]       
+    def _build_snippet_index(self) -> Dict[Tuple[str, str], Tuple[SongSnippet, ...]]:
+        snippet_index = dict()
+
+        for (pre_transition_genre, post_transition_genre), phase_ids in self._transition_phase_ids.items():
+            snippets = list()
 
-        snippets = list()
-        for transition_timestamp in transition_timestamps:
-            snippet_id = transition_in_song_id = sorted(
-                self.metadata_dict.keys()).index(transition_timestamp)
+            for phase_id in phase_ids:
+                if phase_id == len(self.phase_boundaries) - 1:
+                    snippet_end_timestamp = len(self.pcm)
+                else: 
+                    snippet_end_timestamp = self.phase_boundaries[phase_id + 1]
 
-            snippet_start_timestamp = list(self.metadata_dict.keys())[
-                transition_in_song_id - 1]
+                snippets.append(
+                    SongSnippet(
+                        self.pcm,
+                        phase_id,
+                        pre_transition_genre,
+                        post_transition_genre,
+                        self.phase_boundaries[phase_id - 1],
+                        self.phase_boundaries[phase_id],
+                        snippet_end_timestamp,
+                        self.downbeats,
+                        self.get_loudness(self.phase_boundaries[phase_id - 1], snippet_end_timestamp)))
 
-            if transition_in_song_id == self.get_number_of_genre_transitions():
-                snippet_end_timestamp = len(self.audio_segment)
-            else: 
-                snippet_end_timestamp = list(self.metadata_dict.keys())[
-                transition_in_song_id + 1]
+            snippet_index[(pre_transition_genre, post_transition_genre)] = tuple(snippets)
 
-            snippets.append(
-                SongSnippet(
-                    self.audio_segment,
-                    snippet_id,
-                    pre_transition_genre,
-                    post_transition_genre,
-                    snippet_start_timestamp,
-                    transition_timestamp,
-                    snippet_end_timestamp))
+        return snippet_index
 
-        return snippets
+    def get_snippets_by_genres(self, pre_transition_genre: str, post_transition_genre: str) -> Tuple[SongSnippet, ...]:
+        """
+        Returns the song's snippets transitioning between the given genres, in the order of the song.
+        The snippets are built once, as the first lookup needs the song's PCM anyway. Later lookups are a dictionary hit.
+        """
+        if self._snippet_index is None:
+            with self._snippet_index_lock:
+                if self._snippet_index is None:
+                    self._snippet_index = self._build_snippet_index()
+
+        return self._snippet_index[(pre_transition_genre, post_transition_genre)]
+
+    def get_full_snippets_by_genres(self, pre_transition_genre: str, post_transition_genre: str) -> List[SongSnippet]:
+        # A copy, as callers commonly pop from it
+        return list(self.get_snippets_by_genres(pre_transition_genre, post_transition_genre))
 
 
     def get_end_to_end_snippet(self, transition_timestamp: int):
         return SongSnippet(
-            self.audio_segment,
+            self.pcm,
             None,
             None,
             None,
             0,
             transition_timestamp,
-            len(self.audio_segment)
+            len(self.pcm),
+            self.downbeats,
+            self.get_loudness(0, len(self.pcm))
         )
 
 
 
 class SongDatabase:
-    def __init__(self) -> None:
-        datafiles = Path("./tests/data/")
+    """
+    The songs and the snippets played for each transition type, as configured by the catalog (see `catalog`).
+
+    Songs are only decoded once a transition type referring to them is requested for the first time.
+    As the database is read-only after construction, a single instance is shared by all sessions, see `library`.
 
+    A `catalog` read before can be passed instead of reading `catalog_file`.
+    Songs whose catalog entry is unchanged from the `previous` database are taken over with their decoded PCM.
+    """
+
+    def __init__(self, catalog_file: Path = CATALOG_FILE, catalog: Dict[str, Any] = None, previous: "SongDatabase" = None) -> None:
+        catalog = catalog or read_catalog(catalog_file)
+
+        self.song_entries: Dict[str, Dict[str, Any]] = catalog["songs"]
         self.song_database = {
-            "tsunami": Song(Path(datafiles / "tsunami.mp3"), Path(datafiles / "tsunami.txt")),
-            "shot-me-down": Song(Path(datafiles / "shot-me-down.mp3"), Path(datafiles / "shot-me-down.txt")),
-            "animals": Song(Path(datafiles / "animals.mp3"), Path(datafiles / "animals.txt")),
-            "requiem-for-a-tower": Song(Path(datafiles / "requiem-for-a-tower.mp3"), Path(datafiles / "requiem-for-a-tower.txt")),
-            "drink-up-me-hearties": Song(Path(datafiles / "drink-up-me-hearties.mp3"), Path(datafiles / "drink-up-me-hearties.txt")),
-            "music": Song(Path(datafiles / "music.mp3"), Path(datafiles / "music.txt")),
-            "river-flows-in-you": Song(Path(datafiles / "river-flows-in-you.mp3"), Path(datafiles / "river-flows-in-you.txt"))
+            song_name: self._get_song(Path(catalog_file).parent, song_name, song_entry, previous)
+            for song_name, song_entry in catalog["songs"].items()
         }
-        
-        self.snippets_by_transition_type = {
-            "trafficLight": self.song_database["river-flows-in-you"].get_end_to_end_snippet(5_000),
-            "highwayEntrance": self.song_database["shot-me-down"].get_full_snippets_by_genres("low", "high").pop(),
-            "tunnelEntrance": self.song_database["animals"].get_full_snippets_by_genres("low", "high").pop(),
-            "tunnelExit": self.song_database["drink-up-me-hearties"].get_full_snippets_by_genres("low", "high").pop(),
-            "highwayJunction": self.song_database["drink-up-me-hearties"].get_full_snippets_by_genres("crescendo", "high2").pop(),
-            "speedLimitRevocation": self.song_database["requiem-for-a-tower"].get_full_snippets_by_genres("low", "high").pop(),
-            "highwayExit": self.song_database["river-flows-in-you"].get_end_to_end_snippet(25_000),
+
+        self._candidate_factories_by_transition_type: Dict[str, Callable[[], SnippetCandidates]] = {
+            transition_type: self._get_candidates_factory(transition_type_entry)
+            for transition_type, transition_type_entry in catalog["transition_types"].items()
         }
 
+        self.candidates_by_transition_type: Dict[str, SnippetCandidates] = dict()
+        self._lock = threading.Lock()
 
-    def get_snippet_by_transition_type(self, transition_type) -> SongSnippet:
-        assert transition_type in self.snippets_by_transition_type
-        
-        snippet = self.snippets_by_transition_type[transition_type]
+    @staticmethod
+    def _get_song(library_dir: Path, song_name: str, song_entry: Dict[str, Any], previous: "SongDatabase" = None) -> Song:
+        if previous is not None and previous.song_entries.get(song_name) == song_entry:
+            return previous.song_database[song_name]
+
+        return Song(
+            library_dir / song_entry["audio_file"],
+            {int(phase_start_timestamp): genre for phase_start_timestamp, genre in song_entry["phases"]},
+            content_hash=song_entry.get("content_hash"),
+            loudness=song_entry.get("loudness"),
+            block_loudness=song_entry.get("block_loudness"),
+            downbeats=song_entry.get("downbeats"))
+
+    def _get_candidate_snippets(self, transition_type_entry: Dict[str, Any]) -> List[SongSnippet]:
+        """
+        Returns the snippets configured by a transition type's catalog entry, the default snippet last.
+        """
+        if "candidates" in transition_type_entry:
+            candidate_entries = transition_type_entry["candidates"]
+            snippets = [snippet for candidate_entry in candidate_entries[1:] for snippet in self._get_candidate_snippets(candidate_entry)]
+            return snippets + self._get_candidate_snippets(candidate_entries[0])
+
+        song = self.song_database[transition_type_entry["song"]]
+
+        if "end_to_end" in transition_type_entry:
+            return [song.get_end_to_end_snippet(transition_type_entry["end_to_end"])]
+
+        # The last snippet with the given genres is the default, as it tends to be the most developed one
+        return list(song.get_snippets_by_genres(*transition_type_entry["genres"]))
+
+    def _get_candidates_factory(self, transition_type_entry: Dict[str, Any]) -> Callable[[], SnippetCandidates]:
+        def get_candidates() -> SnippetCandidates:
+            snippets = self._get_candidate_snippets(transition_type_entry)
+            return SnippetCandidates(snippets, default=snippets[-1])
+
+        return get_candidates
+
+    def get_transition_types(self) -> List[str]:
+        return list(self._candidate_factories_by_transition_type)
+
+    def preload(self, max_workers: int = None) -> Dict[Path, float]:
+        """
+        Decodes all songs in parallel instead of on first use, returning the time spent per song.
+        """
+        durations = pcm_cache.ingest([song.audio_file for song in self.song_database.values()], max_workers=max_workers)
+
+        for song in self.song_database.values():
+            song.pcm # pylint: disable=pointless-statement
+
+        return durations
+
+    def get_candidates_by_transition_type(self, transition_type) -> SnippetCandidates:
+        assert transition_type in self._candidate_factories_by_transition_type
         
-        return snippet
\ No newline at end of file
+        candidates = self.candidates_by_transition_type.get(transition_type)
+        if candidates is not None:
+            return candidates
+
+        # Decoding happens outside of the lock, the song's own lock makes sure it is decoded only once
+        candidates = self._candidate_factories_by_transition_type[transition_type]()
+
+        with self._lock:
+            return self.candidates_by_transition_type.setdefault(transition_type, candidates)
+
+    def get_snippet_by_transition_type(self, transition_type, pre_transition_gap: int = None, post_transition_gap: int = None,
+            recent_snippets: Collection[SongSnippet] = ()) -> SongSnippet:
+        """
+        Returns the transition type's snippet best fitting the gaps (in ms) before and after the transition, 
+        see `SnippetCandidates.select`, or its default snippet if no gaps are given.
+        """
+        return self.get_candidates_by_transition_type(transition_type).select(pre_transition_gap, post_transition_gap, recent_snippets)
@@ -2,13 +2,19 @@ import time
 from pydub import AudioSegment
 import threading
 from pathlib import Path
+from typing import Callable
 
 from .canvas.transition_spec_canvas import TransitionCanvas
 from .player import Player
+from .sinks import AudioSink, PyAudioSink
 from fire import Fire
 
 class VizPlayer:
-    def __init__(self, write_canvas: bool = False):    
+    def __init__(self, write_canvas: bool = False, sink_factory: Callable[[], AudioSink] = PyAudioSink, stats_file: Path = None):
+        # Called for a new sink whenever playback starts
+        self.sink_factory = sink_factory
+        # Playback stats are written here during playback, see `Player`
+        self.stats_file = stats_file
         self.canvas: TransitionCanvas = None
         self.playback_state = None
         self._player = None
@@ -28,27 +34,34 @@ class VizPlayer:
         self.canvas.draw_segment(segment)
         self.canvas.save("latest_audio.jpg")
 
-    def play(self, segment: AudioSegment):
-        self._player = Player(segment)
-        self.playback_state = self._player.play_stream()
+    def play(self, segment: AudioSegment, start_ms: int = 0):
+        self._player = Player(segment, sink=self.sink_factory(), stats_file=self.stats_file)
+        self.playback_state = self._player.play_stream(start_ms)
         
         if self.write_canvas:
             self._update_canvas(segment)
             self.monitor_marker_async(interval=.25)
 
-    def swap_segment(self, segment: AudioSegment):
-        # TODO: CANNOT SWAP BETWEEN SEGMENTS WITH DIFFERENT CHANNELS COUNTS
+    def swap_segment(self, segment: AudioSegment, start_ms: int = 0):
+        """
+        Swaps `segment` in at the current position, or starts playing it from `start_ms` on if nothing is playing.
+        """
         if not self.is_playing():
-            self.play(segment)
+            self.play(segment, start_ms)
             return 
 
-        self.playback_state.swap_segment = segment
+        # The open output cannot change its format. Mixes of ingested songs are all in the canonical format
+        segment_format = (segment.frame_rate, segment.channels)
+        if segment_format != self.playback_state.get_format():
+            raise ValueError(f"Cannot swap in a segment of format {segment_format} into output of format {self.playback_state.get_format()}")
+
+        self.playback_state.swap(segment)
         
         if self.write_canvas:
             self._update_canvas(segment)
 
     def stop(self):
-        self.playback_state.request_stop = True
+        self.playback_state.stop()
 
     def monitor_marker_async(self, interval: float = .1):
         def run():
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from soundsride.beats import analyze_beats # pylint: disable=import-error
+from soundsride.mixer import PcmBuffer # pylint: disable=import-error
+
+FRAME_RATE = 44100
+
+
+def get_click_track(bpm: float, duration_s: float, first_beat_s: float = .3, downbeat_position: int = 1):
+    samples = np.random.default_rng(0).normal(0, .01, int(duration_s * FRAME_RATE)).astype(np.float32)
+    click = np.sin(2 * np.pi * 1000 * np.arange(441) / FRAME_RATE) * np.exp(-np.arange(441) / 80)
+
+    beats = np.arange(first_beat_s, duration_s - .1, 60 / bpm)
+    for beat_id, beat in enumerate(beats):
+        start = int(beat * FRAME_RATE)
+        samples[start:start + len(click)] += (.9 if beat_id % 4 == downbeat_position else .3) * click
+
+    return PcmBuffer(np.repeat(samples[:, np.newaxis], 2, axis=1), FRAME_RATE), beats * 1000, beats[downbeat_position::4] * 1000
+
+
+@pytest.mark.parametrize("bpm", [90, 128, 150])
+def test_analyze_beats(bpm):
+    pcm, beats, downbeats = get_click_track(bpm, 60)
+
+    analysis = analyze_beats(pcm)
+
+    assert analysis["tempo"] == pytest.approx(bpm, abs=.5)
+    for expected, detected in [(beats, analysis["beats"]), (downbeats, analysis["downbeats"])]:
+        # Every expected beat is detected within 20 ms
+        assert np.max(np.min(np.abs(np.subtract.outer(expected, detected)), axis=1)) < 20
+
+
+@pytest.mark.parametrize("duration_s", [.1, .3, .6, 1.])
+def test_analyze_beats_of_short_audio(duration_s):
+    pcm = PcmBuffer(np.random.default_rng(0).normal(0, .1, (int(duration_s * FRAME_RATE), 2)).astype(np.float32), FRAME_RATE)
+
+    assert analyze_beats(pcm) == dict(tempo=None, beats=list(), downbeats=list())
@@ -0,0 +1,58 @@
+import functools
+import os
+
+from soundsride import pcm_cache # pylint: disable=import-error
+from soundsride.catalog import write_catalog # pylint: disable=import-error
+from soundsride.library import LibraryManager # pylint: disable=import-error
+
+from test_mixer import get_sine_segment # pylint: disable=import-error
+
+
+def add_song(library_dir, catalog, song_name, frequency, mtime):
+    audio_file = library_dir / f"{song_name}.wav"
+    get_sine_segment(20_000, frequency).export(audio_file, format="wav")
+    os.utime(audio_file, ns=(mtime, mtime))
+
+    catalog["songs"][song_name] = dict(audio_file=audio_file.name, phases=[[0, "low"], [10_000, "high"]])
+    catalog["transition_types"][song_name] = dict(song=song_name, genres=["low", "high"])
+
+
+def write_library(library_dir, catalog, mtime):
+    write_catalog(library_dir / "catalog.json", catalog)
+    os.utime(library_dir / "catalog.json", ns=(mtime, mtime))
+
+
+def test_library_manager_publishes_snapshots(tmp_path, monkeypatch):
+    monkeypatch.setattr(pcm_cache, "load_pcm", functools.partial(pcm_cache.load_pcm, cache_dir=tmp_path / "cache"))
+
+    catalog = dict(songs=dict(), transition_types=dict())
+    add_song(tmp_path, catalog, "first", 440, 1_000_000_000)
+    write_library(tmp_path, catalog, 1_000_000_000)
+
+    library_manager = LibraryManager(tmp_path / "catalog.json")
+    first_snapshot = library_manager.snapshot
+    first_song = first_snapshot.song_database["first"]
+
+    assert not library_manager.poll()
+
+    add_song(tmp_path, catalog, "second", 660, 2_000_000_000)
+    write_library(tmp_path, catalog, 2_000_000_000)
+
+    assert library_manager.poll()
+    second_snapshot = library_manager.snapshot
+
+    assert sorted(first_snapshot.song_database) == ["first"]
+    assert sorted(second_snapshot.song_database) == ["first", "second"]
+    assert second_snapshot.song_database["first"] is first_song
+    assert second_snapshot.candidates_by_transition_type.keys() == {"first", "second"}
+
+    # Replacing an audio file without updating the catalog
+    add_song(tmp_path, catalog, "first", 550, 3_000_000_000)
+
+    assert library_manager.poll()
+    third_snapshot = library_manager.snapshot
+
+    assert third_snapshot.song_database["first"] is not first_song
+    assert third_snapshot.song_database["second"] is second_snapshot.song_database["second"]
+    assert third_snapshot.song_entries["first"]["content_hash"] == pcm_cache.get_content_hash(tmp_path / "first.wav")
+    assert not library_manager.poll()
@@ -0,0 +1,360 @@
+import gc
+import time
+import weakref
+
+import numpy as np
+import pytest
+from pydub import AudioSegment
+
+from soundsride.song import SongSnippet # pylint: disable=import-error
+from soundsride.mix_plan import MixPlan # pylint: disable=import-error
+from soundsride.fades import FADE_CURVES, fade_in_gain, fade_out_gain # pylint: disable=import-error
+from soundsride.snippet_cache import SnippetRenderCache # pylint: disable=import-error
+from soundsride.loudness import TARGET_LOUDNESS, combine_block_loudness, measure_block_loudness, measure_loudness # pylint: disable=import-error
+from soundsride.mixer import Mixer, PcmBuffer, WindowedMixSegment, segment_to_array, array_to_segment # pylint: disable=import-error
+
+FRAME_RATE = 44100
+
+
+def get_sine_segment(duration_ms: int, frequency: float, amplitude: float = .25, channels: int = 2) -> AudioSegment:
+    t = np.arange(int(duration_ms * FRAME_RATE / 1000)) / FRAME_RATE
+    samples = (amplitude * np.sin(2 * np.pi * frequency * t) * 32767).astype(np.int16)
+    samples = np.repeat(samples[:, np.newaxis], channels, axis=1)
+    return AudioSegment(samples.tobytes(), frame_rate=FRAME_RATE, sample_width=2, channels=channels)
+
+
+FIRST_SONG = PcmBuffer.from_audio_segment(get_sine_segment(60_000, 440))
+SECOND_SONG = PcmBuffer.from_audio_segment(get_sine_segment(60_000, 660))
+
+
+def get_crossfading_mix_plan(second_transition: int = 40_000) -> MixPlan:
+    first_song, second_song = FIRST_SONG, SECOND_SONG
+
+    mix_plan = MixPlan()
+    mix_plan.snippet_render_cache = None
+    mix_plan.add_snippet_transition(SongSnippet(first_song, 0, "low", "high", 0, 10_000, 40_000), 10_000, "EARLY")
+    mix_plan.add_snippet_transition(SongSnippet(second_song, 1, "low", "high", 5_000, 30_000, 50_000), second_transition, "EARLY")
+    mix_plan.set_snippet_transitions(transition_type="crossfade")
+
+    return mix_plan
+
+
+def overlay_reference(mix_plan: MixPlan) -> AudioSegment:
+    segment = AudioSegment.silent(mix_plan.get_length())
+    for scheduled_snippet in mix_plan.scheduled_snippets:
+        segment = segment.overlay(scheduled_snippet.get_audio_segment(), position=scheduled_snippet.get_scheduled_start())
+    return segment
+
+
+def test_array_roundtrip():
+    segment = get_sine_segment(1_000, 440)
+    samples = segment_to_array(segment)
+
+    assert samples.dtype == np.float32
+    assert samples.shape == (FRAME_RATE, 2)
+    assert array_to_segment(samples, FRAME_RATE).raw_data == segment.raw_data
+
+
+def test_mixer_clips_at_buffer_end():
+    mixer = Mixer(100, FRAME_RATE, 1)
+    mixer.add(np.full((50, 1), .5, dtype=np.float32), 80)
+    mixer.add(np.full((50, 1), .75, dtype=np.float32), 80, envelope=np.full(50, 2, dtype=np.float32))
+
+    assert np.all(mixer.buffer[:80] == 0)
+    assert np.allclose(mixer.buffer[80:], 2.)
+    assert np.max(segment_to_array(mixer.to_audio_segment())) < 1.
+
+
+def test_mixer_adds_scaled_samples_in_place():
+    samples = FIRST_SONG.samples[:10_000]
+
+    # Contiguous float32 samples, strided samples and samples of another dtype
+    for song_samples in [samples, np.repeat(samples, 2, axis=0)[::2], samples.astype(np.float64)]:
+        mixer = Mixer(12_000, FRAME_RATE, 2)
+        mixer.add(song_samples, -100, gain=.5)
+        mixer.add(song_samples, 5_000, gain=.5)
+
+        expected = np.zeros_like(mixer.buffer)
+        expected[:9_900] += samples[100:] * np.float32(.5)
+        expected[5_000:] += samples[:7_000] * np.float32(.5)
+
+        assert np.allclose(mixer.buffer, expected, atol=1e-7)
+
+
+def test_mix_plan_matches_overlay_rendering():
+    mix_plan = get_crossfading_mix_plan()
+
+    rendered = mix_plan.to_audio_segment()
+    reference = overlay_reference(mix_plan)
+
+    assert (rendered.frame_rate, rendered.channels, rendered.sample_width) == (FRAME_RATE, 2, 2)
+    assert len(rendered) == len(reference)
+    # The overlay reference quantizes each snippet before summing them
+    assert np.max(np.abs(segment_to_array(rendered) - segment_to_array(reference))) == pytest.approx(0, abs=1e-4)
+
+
+def test_render_window_matches_full_rendering():
+    mix_plan = get_crossfading_mix_plan()
+    full = mix_plan.to_array()
+
+    window = mix_plan.render_window(14_000, 19_000)
+
+    assert np.array_equal(window, full[14_000 * 441 // 10:19_000 * 441 // 10])
+
+
+def test_windowed_mix_segment():
+    mix_plan = get_crossfading_mix_plan()
+    full = mix_plan.to_audio_segment()
+
+    segment = WindowedMixSegment(mix_plan, window_length=3_000)
+    segment.prefetch(12_500)
+
+    assert sorted(segment._windows) == [4, 5] # pylint: disable=protected-access
+    assert len(segment) == len(full)
+    assert segment[14_750:15_000].raw_data == full[14_750:15_000].raw_data
+    assert segment[17_900:18_100].raw_data == full[17_900:18_100].raw_data
+    assert segment.to_audio_segment().raw_data == full.raw_data
+
+
+def test_windowed_mix_segment_frames():
+    mix_plan = get_crossfading_mix_plan()
+    full = mix_plan.to_array()
+
+    # Window origins of this length fall between frames
+    segment = WindowedMixSegment(mix_plan, window_length=333)
+
+    assert segment.frame_count() == len(full)
+    for start_frame, end_frame in [(0, 256), (14_685, 14_686), (14_600, 30_000), (len(full) - 100, len(full) + 100)]:
+        assert np.array_equal(segment.get_frames(start_frame, end_frame), full[start_frame:end_frame])
+
+
+def test_retired_windowed_mix_segment_stops_prefetching():
+    mix_plan = get_crossfading_mix_plan()
+    full = mix_plan.to_array()
+
+    segment = WindowedMixSegment(mix_plan, window_length=10_000)
+    segment.retire()
+
+    assert np.array_equal(segment.get_frames(0, 256), full[:256])
+    time.sleep(.1)
+    assert list(segment._windows) == [0] # pylint: disable=protected-access
+
+
+def test_render_decimated_matches_full_rendering():
+    mix_plan = get_crossfading_mix_plan()
+
+    assert np.allclose(mix_plan.render_decimated(100), mix_plan.to_array()[::100], atol=1e-6)
+
+
+def test_snippet_render_cache():
+    cache = SnippetRenderCache()
+    reference = get_crossfading_mix_plan().to_array()
+
+    mix_plan = get_crossfading_mix_plan()
+    mix_plan.snippet_render_cache = cache
+    assert np.array_equal(mix_plan.to_array(), reference)
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    mix_plan = get_crossfading_mix_plan()
+    mix_plan.snippet_render_cache = cache
+    assert np.array_equal(mix_plan.to_array(), reference)
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # Delaying the second transition moves the first snippet's fade-out,
+    # while the second snippet is just shifted in time and keeps its relative fade geometry
+    mix_plan = get_crossfading_mix_plan(second_transition=45_000)
+    mix_plan.snippet_render_cache = cache
+    mix_plan.to_array()
+    assert (cache.hits, cache.misses) == (3, 3)
+
+
+def test_snippet_render_cache_does_not_keep_songs_alive():
+    cache = SnippetRenderCache()
+    song = PcmBuffer(FIRST_SONG.samples.copy(), FRAME_RATE)
+    song_reference = weakref.ref(song)
+
+    mix_plan = MixPlan()
+    mix_plan.snippet_render_cache = cache
+    mix_plan.add_snippet_transition(SongSnippet(song, 0, "low", "high", 0, 10_000, 40_000), 10_000, "EARLY")
+    mix_plan.add_snippet_transition(SongSnippet(SECOND_SONG, 1, "low", "high", 5_000, 30_000, 50_000), 40_000, "EARLY")
+    mix_plan.set_snippet_transitions(transition_type="crossfade")
+    mix_plan.to_array()
+    assert len(cache) == 2
+
+    del song, mix_plan
+    gc.collect()
+    assert song_reference() is None
+
+
+def test_snippet_render_cache_eviction():
+    cache = SnippetRenderCache(max_bytes=100)
+    cache.put("a", np.zeros(10, dtype=np.float32))
+    cache.put("b", np.zeros(10, dtype=np.float32))
+    cache.get("a")
+    cache.put("c", np.zeros(10, dtype=np.float32))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert (cache.evictions, cache.current_bytes) == (1, 80)
+
+
+def test_dirty_intervals():
+    mix_plan = get_crossfading_mix_plan()
+
+    assert mix_plan.get_dirty_intervals(None) == [(0, 60_000)]
+    assert mix_plan.get_dirty_intervals(get_crossfading_mix_plan()) == []
+    # The crossfade and the second snippet move, the first snippet's view of its song is just extended
+    assert mix_plan.get_dirty_intervals(get_crossfading_mix_plan(second_transition=45_000)) == [(15_000, 65_000)]
+
+
+def get_three_snippet_mix_plan(second_transition: int = 40_000) -> MixPlan:
+    mix_plan = MixPlan()
+    mix_plan.snippet_render_cache = None
+    mix_plan.add_snippet_transition(SongSnippet(FIRST_SONG, 0, "low", "high", 0, 10_000, 40_000), 10_000, "EARLY")
+    mix_plan.add_snippet_transition(SongSnippet(SECOND_SONG, 1, "low", "high", 5_000, 30_000, 50_000), second_transition, "EARLY")
+    mix_plan.add_snippet_transition(SongSnippet(FIRST_SONG, 2, "low", "high", 10_000, 30_000, 60_000), 70_000, "EARLY")
+    mix_plan.set_snippet_transitions(transition_type="crossfade")
+
+    return mix_plan
+
+
+def test_dirty_intervals_only_cover_moved_parts():
+    previous = WindowedMixSegment(get_three_snippet_mix_plan(), window_length=10_000)
+    previous.to_audio_segment()
+
+    mix_plan = get_three_snippet_mix_plan(second_transition=41_000)
+    segment = WindowedMixSegment(mix_plan, window_length=10_000, previous=previous)
+
+    # The second snippet and its crossfades move, the first snippet's body and the third snippet stay clean
+    assert segment.dirty_intervals == [(15_000, 53_000)]
+
+    assert segment._get_window(0) is previous._get_window(0) # pylint: disable=protected-access
+    assert segment.to_audio_segment().raw_data == mix_plan.to_audio_segment().raw_data
+
+
+def test_windowed_mix_segment_patches_previous_windows():
+    previous = WindowedMixSegment(get_crossfading_mix_plan(), window_length=10_000)
+    previous.to_audio_segment()
+
+    mix_plan = get_crossfading_mix_plan()
+    mix_plan._scheduled_snippets.pop() # pylint: disable=protected-access
+    mix_plan.add_snippet_transition(SongSnippet(SECOND_SONG, 1, "low", "high", 5_000, 30_000, 60_000), 40_000, "EARLY")
+    mix_plan.set_snippet_transitions(transition_type="crossfade")
+
+    segment = WindowedMixSegment(mix_plan, window_length=10_000, previous=previous)
+
+    # Only the frames the second snippet was extended by differ
+    assert segment.dirty_intervals == [(60_000, 70_000)]
+    assert segment._get_window(0) is previous._get_window(0) # pylint: disable=protected-access
+    assert segment.to_audio_segment().raw_data == mix_plan.to_audio_segment().raw_data
+
+
+@pytest.mark.parametrize("curve", list(FADE_CURVES))
+def test_fade_curves(curve):
+    progress = np.linspace(-.5, 1.5, 201)
+
+    gain_in = fade_in_gain(progress, curve)
+    gain_out = fade_out_gain(progress, curve)
+
+    assert gain_in.dtype == np.float32
+    assert np.all(gain_in[progress <= 0] == 0) and np.all(gain_in[progress >= 1] == 1)
+    assert np.all(gain_out[progress <= 0] == 1) and np.all(gain_out[progress >= 1] == 0)
+    assert np.all(np.diff(gain_in) >= 0)
+
+    if curve == "equal_power":
+        assert np.allclose(gain_in ** 2 + gain_out ** 2, 1, atol=1e-6)
+
+
+def test_crossfade_uses_transition_mode_curve():
+    mix_plan = get_crossfading_mix_plan()
+    first_snippet, second_snippet = mix_plan.scheduled_snippets
+
+    assert first_snippet._fade_out_curve == second_snippet._fade_in_curve == "equal_power" # pylint: disable=protected-access
+
+    envelope = second_snippet.get_gain_envelope(441_000, FRAME_RATE, 0, 3 * 44_100)
+    assert envelope[0] == 0
+    assert envelope[66_150] == pytest.approx(np.sqrt(.5))
+
+
+def test_snippet_samples_are_views_of_song_pcm():
+    mix_plan = get_crossfading_mix_plan()
+    first_snippet, second_snippet = mix_plan.scheduled_snippets
+
+    assert np.shares_memory(first_snippet.get_samples(FRAME_RATE, 2), FIRST_SONG.samples)
+
+    parts = second_snippet.get_rendered_parts(FRAME_RATE, 2)
+    assert [offset for offset, _, _ in parts] == [0, 3 * 44_100]
+    assert not np.shares_memory(parts[0][1], SECOND_SONG.samples)
+    assert np.shares_memory(parts[1][1], SECOND_SONG.samples)
+
+
+def test_mix_plan_converts_snippet_formats():
+    mono_song = PcmBuffer.from_audio_segment(get_sine_segment(60_000, 440, channels=1).set_frame_rate(22_050))
+
+    mix_plan = MixPlan()
+    mix_plan.add_snippet_transition(SongSnippet(mono_song, 0, "low", "high", 0, 10_000, 40_000), 10_000, "EARLY")
+    mix_plan.add_snippet_transition(SongSnippet(SECOND_SONG, 1, "low", "high", 5_000, 30_000, 50_000), 40_000, "EARLY")
+    mix_plan.set_snippet_transitions(transition_type="crossfade")
+
+    samples = mix_plan.to_array()
+
+    assert mix_plan.get_format() == (FRAME_RATE, 2, 2)
+    assert samples.shape == (60 * FRAME_RATE, 2)
+    assert np.array_equal(samples[:, 0], samples[:, 1])
+
+
+def test_iter_blocks_matches_full_rendering():
+    mix_plan = get_crossfading_mix_plan()
+    full = mix_plan.to_array()
+
+    blocks = list(mix_plan.iter_blocks(start_ms=12_000, block_frames=10_000))
+
+    assert all(len(block) == 10_000 for block in blocks[:-1])
+    assert 0 < len(blocks[-1]) <= 10_000
+    assert np.array_equal(np.concatenate(blocks), full[12 * FRAME_RATE:])
+
+
+def test_crossfade_partners_align_on_frames():
+    # 10_001 ms at 44.1 kHz lies between frames, which must not shift one fade against the other
+    mix_plan = get_crossfading_mix_plan(second_transition=40_001)
+    first_snippet, second_snippet = mix_plan.scheduled_snippets
+
+    assert second_snippet.get_scheduled_transition_frame() == 40_001 * 441 // 10
+    assert first_snippet._fade_out_min_frame == second_snippet._fade_in_min_frame # pylint: disable=protected-access
+    assert first_snippet._fade_out_max_frame == second_snippet._fade_in_max_frame # pylint: disable=protected-access
+    assert first_snippet.get_scheduled_end_frame() == second_snippet.get_scheduled_start_frame() + 3 * FRAME_RATE
+    assert len(mix_plan.to_array()) == second_snippet.get_scheduled_end_frame()
+
+
+def test_cuts_snap_to_downbeats():
+    # Downbeats of the second song every 2 s starting at 100 ms
+    second_snippet = SongSnippet(SECOND_SONG, 1, "low", "high", 5_000, 30_000, 50_000, downbeats=np.arange(100, 60_000, 2_000))
+
+    mix_plan = MixPlan()
+    mix_plan.add_snippet_transition(SongSnippet(FIRST_SONG, 0, "low", "high", 0, 10_000, 40_000), 10_000, "EARLY")
+    mix_plan.add_snippet_transition(second_snippet, 40_000, "EARLY")
+    mix_plan.set_snippet_transitions(transition_type="cut")
+
+    first_snippet, second_snippet = mix_plan.scheduled_snippets
+
+    # The overlap zone spans 15_000 to 40_000 in the mix, its middle at 27_500 is at 17_500 in the second song,
+    # whose closest downbeat at 18_100 is at 28_100 in the mix
+    assert second_snippet.get_scheduled_start() == first_snippet.get_scheduled_end() == 28_100
+
+
+def test_loudness_normalization():
+    reference = get_crossfading_mix_plan().to_array()
+
+    mix_plan = get_crossfading_mix_plan()
+    for scheduled_snippet in mix_plan.scheduled_snippets:
+        # 6 dB below the target, so twice the amplitude
+        scheduled_snippet.song_snippet.loudness = TARGET_LOUDNESS - 20 * np.log10(2)
+
+    assert mix_plan.scheduled_snippets[0].get_normalization_gain() == pytest.approx(2)
+    assert np.allclose(mix_plan.to_array(), 2 * reference, atol=1e-6)
+
+    song_samples = FIRST_SONG.samples[:10 * FRAME_RATE]
+    block_loudness = measure_block_loudness(song_samples, FRAME_RATE)
+    assert len(block_loudness) == 10
+    assert combine_block_loudness(block_loudness, 0, 10_000) == pytest.approx(measure_loudness(song_samples), abs=.01)
@@ -0,0 +1,123 @@
+import json
+import time
+import wave
+
+import numpy as np
+
+from soundsride.mixer import PcmBuffer, segment_to_array # pylint: disable=import-error
+from soundsride.playback_stats import Histogram # pylint: disable=import-error
+from soundsride.player import PlaybackState, Player # pylint: disable=import-error
+from soundsride.sinks import FreeRunningSink, NullSink, WavSink # pylint: disable=import-error
+
+from test_mixer import FIRST_SONG, SECOND_SONG, FRAME_RATE # pylint: disable=import-error
+
+
+def read_wav(wav_file) -> np.ndarray:
+    with wave.open(str(wav_file), "rb") as wav:
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16).reshape(-1, wav.getnchannels())
+
+    return samples.astype(np.float32) / 32768
+
+
+def test_wav_sink_records_playback(tmp_path):
+    song = PcmBuffer(FIRST_SONG.samples[:3 * FRAME_RATE], FRAME_RATE)
+
+    player = Player(song, sink=WavSink(tmp_path / "playback.wav", real_time=False), stats_file=tmp_path / "playback_stats.json")
+    playback_state = player.play_stream()
+    playback_state.playback_future.result(timeout=10)
+
+    recorded = read_wav(tmp_path / "playback.wav")
+    expected = segment_to_array(song.to_audio_segment())
+
+    # Playback ends with the device buffer the song ends in
+    assert len(expected) <= len(recorded) < len(expected) + 256
+    assert np.array_equal(recorded[:len(expected)], expected)
+    # The last buffer is heard until its output time plus its duration, even though it was written to the file at once
+    time.sleep(2 * 256 / FRAME_RATE)
+    assert playback_state.get_sample_position() == len(recorded)
+    assert playback_state.get_format() == (FRAME_RATE, 2)
+
+    stats = json.loads((tmp_path / "playback_stats.json").read_text())
+    assert stats["underruns"] == stats["overruns"] == 0
+    assert stats["callback_durations"]["count"] == len(recorded) // 256
+
+
+def test_swap_crossfades_to_the_same_position(tmp_path):
+    first_song = PcmBuffer(FIRST_SONG.samples[:3 * FRAME_RATE], FRAME_RATE)
+    second_song = PcmBuffer(SECOND_SONG.samples[:3 * FRAME_RATE], FRAME_RATE)
+
+    playback_state = Player(first_song, sink=WavSink(tmp_path / "playback.wav")).play_stream()
+    while playback_state.get_sample_position() < FRAME_RATE:
+        time.sleep(.01)
+
+    playback_state.swap(second_song)
+    playback_state.playback_future.result(timeout=10)
+
+    recorded = read_wav(tmp_path / "playback.wav")[:3 * FRAME_RATE]
+    # Jumping between the sines would step by up to twice their amplitude, the crossfade at most adds up their slopes
+    max_step = np.abs(np.diff(first_song.samples, axis=0)).max() + np.abs(np.diff(second_song.samples, axis=0)).max()
+
+    assert np.abs(np.diff(recorded, axis=0)).max() <= max_step
+    assert np.allclose(recorded[:FRAME_RATE], first_song.samples[:FRAME_RATE], atol=1 / 32768)
+    assert np.allclose(recorded[-FRAME_RATE:], second_song.samples[-FRAME_RATE:], atol=1 / 32768)
+
+    # Heard after the two guard buffers at most, plus the feeder waking up
+    assert playback_state.stats.swap_latencies.count == 1
+    assert 0 < playback_state.stats.swap_latencies.max < 100
+
+
+def test_null_sink_plays_in_real_time():
+    song = PcmBuffer(FIRST_SONG.samples[:FRAME_RATE // 2], FRAME_RATE)
+
+    playback_state = Player(song, sink=NullSink()).play_stream()
+    time.sleep(.2)
+
+    assert 0 < playback_state.played_milliseconds < 500
+
+    playback_state.playback_future.result(timeout=10)
+
+
+def test_free_running_sink_is_faster_than_real_time():
+    song = PcmBuffer(FIRST_SONG.samples[:10 * FRAME_RATE], FRAME_RATE)
+
+    start = time.perf_counter()
+    playback_state = Player(song, sink=FreeRunningSink()).play_stream()
+    playback_state.playback_future.result(timeout=10)
+
+    assert time.perf_counter() - start < 5
+
+
+def test_sample_position_is_interpolated_from_clock():
+    playback_state = PlaybackState(1_000, start_frame=500)
+    # Before the first buffer the playback position is where playback starts
+    assert playback_state.get_sample_position() == 500
+
+    # Until its output time the previous buffer is heard, then the position advances in real time up to the buffer's end
+    playback_state.update_clock(1_000, 1_256, time.perf_counter() + .1)
+    assert 880 <= playback_state.get_sample_position() <= 901
+
+    playback_state.update_clock(1_000, 1_256, time.perf_counter() - .05)
+    assert 1_050 <= playback_state.get_sample_position() <= 1_070
+
+    playback_state.update_clock(1_000, 1_256, time.perf_counter() - 1)
+    assert playback_state.get_sample_position() == 1_256
+    assert playback_state.played_milliseconds == 1_256
+
+
+def test_playback_starts_at_given_position(tmp_path):
+    song = PcmBuffer(FIRST_SONG.samples[:3 * FRAME_RATE], FRAME_RATE)
+
+    playback_state = Player(song, sink=WavSink(tmp_path / "playback.wav", real_time=False)).play_stream(start_ms=2_000)
+    assert playback_state.get_sample_position() >= 2 * FRAME_RATE
+    playback_state.playback_future.result(timeout=10)
+
+    recorded = read_wav(tmp_path / "playback.wav")
+    assert np.allclose(recorded[:FRAME_RATE], song.samples[2 * FRAME_RATE:], atol=1 / 32768)
+
+
+def test_histogram():
+    histogram = Histogram([1, 10])
+    for value in [.5, 1, 5, 50]:
+        histogram.record(value)
+
+    assert histogram.get_stats() == dict(count=4, mean=14.125, max=50, buckets={"<=1": 2, "<=10": 1, ">10": 1})
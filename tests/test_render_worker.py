@@ -0,0 +1,52 @@
+import threading
+import time
+
+from soundsride.render_worker import RenderWorker # pylint: disable=import-error
+
+
+def test_submit_returns_immediately_and_coalesces_pending_jobs():
+    published = list()
+    render_started = threading.Event()
+    release_render = threading.Event()
+
+    def render(value):
+        render_started.set()
+        release_render.wait()
+        return value
+
+    worker = RenderWorker(render, published.append)
+
+    start = time.perf_counter()
+    worker.submit("first")
+    assert render_started.wait(1)
+    worker.submit("second")
+    worker.submit("third")
+    assert time.perf_counter() - start < .5
+
+    assert worker.front is None
+    release_render.set()
+    worker.join()
+
+    # The second update was superseded while the first one was rendering
+    assert published == ["first", "third"]
+    assert worker.front == "third"
+    assert worker.get_stats() == dict(processed=2, coalesced=1)
+    worker.stop()
+
+
+def test_failing_and_empty_renders_keep_front_buffer():
+    published = list()
+
+    def render(value):
+        if value == "fail":
+            raise ValueError(value)
+        return value
+
+    worker = RenderWorker(render, published.append)
+    for value in ["first", "fail", None]:
+        worker.submit(value)
+        worker.join()
+
+    assert published == ["first"]
+    assert worker.front == "first"
+    worker.stop()
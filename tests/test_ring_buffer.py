@@ -0,0 +1,60 @@
+import numpy as np
+
+from soundsride.ring_buffer import RingBuffer # pylint: disable=import-error
+
+
+def get_frames(start: int, end: int) -> np.ndarray:
+    # Frame values encode their position
+    return np.repeat(np.arange(start, end, dtype=np.float32)[:, np.newaxis] / 1000, 2, axis=1)
+
+
+def test_ring_buffer_wraps_around():
+    ring_buffer = RingBuffer(100, 2)
+    out = np.zeros((30, 2), dtype=np.float32)
+
+    for start in range(0, 300, 30):
+        assert ring_buffer.write(get_frames(start, start + 30), ring_buffer.get_write_position()) == 30
+        assert ring_buffer.read_into(out) == 30
+        assert np.array_equal(out, get_frames(start, start + 30))
+
+
+def test_ring_buffer_only_writes_free_frames():
+    ring_buffer = RingBuffer(100, 2)
+
+    assert ring_buffer.write(get_frames(0, 150), 0) == 100
+    assert ring_buffer.get_buffered_frames() == 100
+
+
+def test_ring_buffer_underrun_plays_silence_and_skips():
+    ring_buffer = RingBuffer(100, 2)
+    out = np.zeros((30, 2), dtype=np.float32)
+
+    ring_buffer.write(get_frames(0, 10), 0)
+
+    assert ring_buffer.read_into(out) == 10
+    assert np.array_equal(out[:10], get_frames(0, 10))
+    assert not out[10:].any()
+
+    # Frames the consumer already passed are skipped
+    assert ring_buffer.get_write_position() == 30
+    assert ring_buffer.write(get_frames(10, 60), 10) == 50
+    assert ring_buffer.read_into(out) == 30
+    assert np.array_equal(out, get_frames(30, 60))
+
+
+def test_ring_buffer_rewind_keeps_guard():
+    ring_buffer = RingBuffer(100, 2)
+    out = np.zeros((20, 2), dtype=np.float32)
+
+    ring_buffer.write(get_frames(0, 100), 0)
+    ring_buffer.read_into(out)
+
+    assert ring_buffer.rewind(20, guard_frames=10) == 30
+    ring_buffer.write(-get_frames(30, 70), 30)
+
+    ring_buffer.read_into(out)
+    assert np.array_equal(out[:10], get_frames(20, 30))
+    assert np.array_equal(out[10:], -get_frames(30, 40))
+
+    # Nothing beyond the written frames is rewound to
+    assert ring_buffer.rewind(90, guard_frames=10) == 70
@@ -0,0 +1,45 @@
+import functools
+
+import pytest
+from google.protobuf.json_format import ParseDict
+
+# The session draws its canvas with OpenCV and torchaudio
+pytest.importorskip("cv2")
+pytest.importorskip("torchaudio")
+
+from soundsride import pcm_cache # pylint: disable=import-error,wrong-import-position
+from soundsride import session as session_module # pylint: disable=import-error,wrong-import-position
+from soundsride.service.soundsride_service_pb2 import UpdateTransitionSpecRequest # pylint: disable=import-error,wrong-import-position
+from soundsride.song import SongDatabase # pylint: disable=import-error,wrong-import-position
+
+from test_library import add_song, write_library # pylint: disable=import-error,wrong-import-position
+
+
+def test_first_render_is_drawn_after_playback_starts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pcm_cache, "load_pcm", functools.partial(pcm_cache.load_pcm, cache_dir=tmp_path / "cache"))
+
+    catalog = dict(songs=dict(), transition_types=dict())
+    add_song(tmp_path, catalog, "first", 440, 1_000_000_000)
+    catalog["transition_types"] = dict(tunnelEntrance=dict(song="first", genres=["low", "high"]))
+    write_library(tmp_path, catalog, 1_000_000_000)
+    monkeypatch.setattr(session_module, "get_song_database", lambda: SongDatabase(tmp_path / "catalog.json"))
+
+    (tmp_path / "log" / "session").mkdir(parents=True)
+    session = session_module.SoundsRideSession(session_module.AppModel(), session_log_id="session", sink="null")
+
+    request = ParseDict(dict(
+        transitions=[dict(transitionId="1", transitionToGenre="tunnelEntrance", estimatedTimeToTransition=5., estimatedGeoDistanceToTransition=50.)],
+        sessionId=0,
+        initialGenre=""), UpdateTransitionSpecRequest())
+
+    session.update_mix_plan(request, "first-request")
+    session.render_worker.join()
+    session.viz_threadpool.shutdown(wait=True)
+
+    assert session.viz_player.playback_state is not None
+    # The canvas is only saved if drawing it, including the marker of the playback position, did not fail
+    assert (tmp_path / "log" / "session" / "first-request.jpg").exists()
+
+    session.viz_player.stop()
+    session.render_worker.stop()
@@ -0,0 +1,112 @@
+from pathlib import Path
+
+import numpy as np
+
+from soundsride.song import Song, SongDatabase, SongSnippet # pylint: disable=import-error
+from soundsride.library import get_song_database # pylint: disable=import-error
+from soundsride.snippet_selection import SnippetCandidates # pylint: disable=import-error
+from soundsride.mixer import PcmBuffer # pylint: disable=import-error
+from soundsride.catalog import read_catalog, read_phases # pylint: disable=import-error
+from soundsride.pcm_cache import get_cache_key, get_content_hash, ingest, read_cached_pcm, write_cached_pcm # pylint: disable=import-error
+
+from test_mixer import get_sine_segment # pylint: disable=import-error
+
+DATAFILES = Path(__file__).parent / "data"
+
+
+def test_song_database_decodes_lazily():
+    song_database = SongDatabase(DATAFILES / "catalog.json")
+
+    assert all(song._pcm is None for song in song_database.song_database.values()) # pylint: disable=protected-access
+    assert not song_database.candidates_by_transition_type
+
+
+def test_catalog_matches_metadata_files():
+    catalog = read_catalog(DATAFILES / "catalog.json")
+
+    for song_name, song_entry in catalog["songs"].items():
+        assert song_entry["phases"] == read_phases(DATAFILES / f"{song_name}.txt")
+
+    for transition_type_entry in catalog["transition_types"].values():
+        assert transition_type_entry["song"] in catalog["songs"]
+
+
+def test_song_database_is_shared():
+    assert get_song_database() is get_song_database()
+
+
+def test_pcm_cache_roundtrip(tmp_path):
+    pcm = PcmBuffer(np.linspace(-1, 1, 2_000, dtype=np.float32).reshape(-1, 2), 44_100)
+    assert read_cached_pcm("key", tmp_path) is None
+
+    write_cached_pcm("key", pcm, tmp_path)
+    cached_pcm = read_cached_pcm("key", tmp_path)
+
+    assert isinstance(cached_pcm.samples, np.memmap)
+    assert np.array_equal(cached_pcm.samples, pcm.samples)
+    assert (cached_pcm.frame_rate, cached_pcm.sample_width) == (44_100, 2)
+    assert get_content_hash(DATAFILES / "tsunami.txt") == get_content_hash(DATAFILES / "tsunami.txt")
+
+
+def test_ingest_fills_pcm_cache_in_canonical_format(tmp_path):
+    audio_files = list()
+    for frequency, channels, frame_rate in [(440, 2, 44_100), (660, 1, 22_050)]:
+        audio_file = tmp_path / f"{frequency}.wav"
+        get_sine_segment(1_000, frequency, channels=channels).set_frame_rate(frame_rate).export(audio_file, format="wav")
+        audio_files.append(audio_file)
+
+    durations = ingest(audio_files, tmp_path / "cache", max_workers=2)
+
+    assert sorted(durations) == sorted(audio_files)
+    for audio_file in audio_files:
+        cached_pcm = read_cached_pcm(get_cache_key(get_content_hash(audio_file)), tmp_path / "cache")
+        assert cached_pcm.samples.shape == (44_100, 2)
+        assert (cached_pcm.frame_rate, cached_pcm.sample_width) == (44_100, 2)
+        assert cached_pcm.to_canonical() is cached_pcm
+
+
+def test_snippet_index():
+    song = Song(DATAFILES / "underground.mp3", DATAFILES / "underground.txt")
+    song._pcm = PcmBuffer(np.zeros((300 * 44_100, 2), dtype=np.float32), 44_100) # pylint: disable=protected-access
+
+    for pre_transition_genre, post_transitions in song.transition_table.items():
+        for post_transition_genre, transition_timestamps in post_transitions.items():
+            snippets = song.get_snippets_by_genres(pre_transition_genre, post_transition_genre)
+            assert [snippet.genre_transition_timestamp for snippet in snippets] == transition_timestamps
+
+            for snippet in snippets:
+                phase_id = song.phase_boundaries.index(snippet.genre_transition_timestamp)
+                assert snippet.snippet_start_timestamp == song.phase_boundaries[phase_id - 1]
+                assert snippet.snippet_end_timestamp == (song.phase_boundaries + [300_000])[phase_id + 1]
+
+    snippets = song.get_full_snippets_by_genres("calm", "long_crescendo")
+    snippets.pop()
+    assert song.get_snippets_by_genres("calm", "long_crescendo")[0] is song.get_full_snippets_by_genres("calm", "long_crescendo")[0]
+    assert len(song.get_full_snippets_by_genres("calm", "long_crescendo")) == len(snippets) + 1
+
+
+def test_snippet_candidates_select_best_fit():
+    pcm = PcmBuffer(np.zeros((120 * 44_100, 2), dtype=np.float32), 44_100)
+    # Pre-transition durations of 5, 10, ..., 50 s, each with 20 s after the transition
+    snippets = [SongSnippet(pcm, i, "low", "high", 0, 5_000 * i, 5_000 * i + 20_000) for i in range(1, 11)]
+    candidates = SnippetCandidates(snippets[::-1], default=snippets[0])
+
+    assert candidates.select() is snippets[0]
+    assert candidates.select(21_000) is snippets[3]
+    assert candidates.select(21_000, recent_snippets=[snippets[3]]) in (snippets[2], snippets[4])
+    assert candidates.select(1_000_000) is snippets[-1]
+
+    snippets[4].loudness = -40
+    assert candidates.select(23_000) is snippets[3]
+
+
+def test_snippet_candidates_select_by_post_transition_fit():
+    pcm = PcmBuffer(np.zeros((120 * 44_100, 2), dtype=np.float32), 44_100)
+    # Pre-transition durations just above 10 s with 5 s after the transition, and a longer one with 60 s after the transition
+    snippets = [SongSnippet(pcm, i, "low", "high", 0, 10_000 + 10 * i, 15_000 + 10 * i) for i in range(20)]
+    snippets.append(SongSnippet(pcm, 20, "low", "high", 0, 10_500, 70_500))
+    candidates = SnippetCandidates(snippets)
+
+    assert candidates.select(10_000) is snippets[0]
+    # The long snippet is far from the best pre-transition fits, but found through the post-transition durations
+    assert candidates.select(10_000, 60_000) is snippets[-1]